@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Convert the Itinerum .csv exports to Parquet files with typed columns, sorted
+# by uuid and timestamp so that each user's rows are one contiguous run. Users
+# are never split across row groups and the file's metadata records where each
+# user's rows start, so the tripbreaker runners can read a user's coordinates
+# straight into columnar arrays (see `run_tripbreaker/parquet_source.py`).
+import argparse
+import calendar
+import ciso8601
+from datetime import date
+import json
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+
+SURVEY_NAME = 'demo'
+PARQUET_DIR = './data/{s}-processing-{date}-parquet'.format(s=SURVEY_NAME,
+                                                            date=date.today())
+
+# declared column types, any other column is stored as a string; timestamps are
+# stored as integer epoch seconds (UTC) as in the typed SQLite database
+COLUMN_TYPES = {
+    'id': pa.int64(),
+    'latitude': pa.float64(),
+    'longitude': pa.float64(),
+    'h_accuracy': pa.float64(),
+    'v_accuracy': pa.float64(),
+    'speed': pa.float64(),
+    'altitude': pa.float64(),
+    'timestamp': pa.int64(),
+    'recorded_at': pa.int64()
+}
+TIMESTAMP_COLUMNS = ('timestamp', 'recorded_at')
+# schema metadata key holding each user's [row group, offset, rows] within the file
+USERS_METADATA_KEY = b'itinerum_users'
+
+
+def epoch_seconds(value):
+    dt = ciso8601.parse_datetime(value)
+    if dt.tzinfo is None:
+        return calendar.timegm(dt.timetuple())
+    return calendar.timegm(dt.utctimetuple())
+
+
+# cast a column of ISO 8601 strings to epoch seconds, timestamps without a zone
+# offset are read as UTC and a column mixing both is parsed value by value
+def epoch_seconds_column(strings):
+    for timestamp_type in (pa.timestamp('us', tz='UTC'), pa.timestamp('us')):
+        try:
+            microseconds = pc.cast(strings, timestamp_type).cast(pa.int64())
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+        return pc.divide(microseconds, 1000000)
+    return pa.array([epoch_seconds(v) if v else None for v in strings.to_pylist()],
+                    type=pa.int64())
+
+
+def read_typed_csv(csv_fp):
+    convert_options = pa_csv.ConvertOptions(
+        column_types={c: pa.string() for c in TIMESTAMP_COLUMNS},
+        strings_can_be_null=True)
+    table = pa_csv.read_csv(csv_fp, convert_options=convert_options)
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if name in TIMESTAMP_COLUMNS:
+            column = epoch_seconds_column(column.combine_chunks())
+        elif name in COLUMN_TYPES:
+            column = column.cast(COLUMN_TYPES[name])
+        elif column.type != pa.string():
+            column = column.cast(pa.string())
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+
+# find the [start, end) rows of each user in a table sorted by uuid
+def user_runs(table):
+    codes = table.column('uuid').combine_chunks().dictionary_encode()
+    indices = codes.indices.to_numpy(zero_copy_only=False)
+    starts = np.flatnonzero(np.concatenate(([True], indices[1:] != indices[:-1])))
+    ends = np.append(starts[1:], len(indices))
+    uuids = codes.dictionary.to_pylist()
+    return [(uuids[indices[s]], int(s), int(e)) for s, e in zip(starts, ends)]
+
+
+# write a table sorted by uuid (and timestamp when it has one) as row groups of
+# about `row_group_rows` rows holding whole users
+def write_parquet_table(table_name, csv_fp, parquet_fp, row_group_rows=100000,
+                        compression='none'):
+    print('Converting {t}...'.format(t=table_name))
+    t0 = time.time()
+    table = read_typed_csv(csv_fp)
+    sort_keys = [('uuid', 'ascending')]
+    if 'timestamp' in table.column_names:
+        sort_keys.append(('timestamp', 'ascending'))
+    table = table.sort_by(sort_keys)
+
+    # group consecutive users into row groups and record where each one starts
+    groups, users = [], {}
+    for uuid, start, end in user_runs(table):
+        if not groups or (end - groups[-1][0] > row_group_rows and groups[-1][1] > groups[-1][0]):
+            groups.append([start, start])
+        users[uuid] = [len(groups) - 1, start - groups[-1][0], end - start]
+        groups[-1][1] = end
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[USERS_METADATA_KEY] = json.dumps(users).encode('utf-8')
+    schema = table.schema.with_metadata(metadata)
+    with pq.ParquetWriter(parquet_fp, schema, compression=compression) as writer:
+        for start, end in groups:
+            writer.write_table(table.slice(start, end - start).replace_schema_metadata(metadata),
+                               row_group_size=max(end - start, 1))
+
+    elapsed = time.time() - t0
+    print('Wrote {n} rows for {u} users to {fp} in {s:.1f} sec ({rate:.0f} rows/sec)'.format(
+        n=table.num_rows, u=len(users), fp=parquet_fp, s=elapsed,
+        rate=table.num_rows / elapsed if elapsed else 0.))
+
+
+
+### main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert Itinerum .csv exports to Parquet.')
+    parser.add_argument('--row-group-rows', type=int, default=100000,
+                        help='target rows per row group, users are never split (default: 100000)')
+    parser.add_argument('--compression', default='none',
+                        help='Parquet compression codec, uncompressed files can be read '
+                             'from a memory map without decompressing (default: none)')
+    args = parser.parse_args()
+
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    table_map = {
+        'coordinates': '{s}-coordinates.csv'.format(s=SURVEY_NAME),
+        'prompt_responses': '{s}-prompt_responses.csv'.format(s=SURVEY_NAME),
+        'survey_responses': '{s}-survey_responses_fixed.csv'.format(s=SURVEY_NAME)
+    }
+    for table_name, csv_fn in table_map.items():
+        write_parquet_table(table_name,
+                            os.path.join('data', csv_fn),
+                            os.path.join(PARQUET_DIR, '{t}.parquet'.format(t=table_name)),
+                            row_group_rows=args.row_group_rows,
+                            compression=args.compression)
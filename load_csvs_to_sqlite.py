@@ -1,15 +1,42 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2017
+import argparse
+import calendar
+import ciso8601
 import csv
 import dataset
 from datetime import date
+import itertools
 import os
+import sqlite3
+import time
 
 
 SURVEY_NAME = 'demo'
-db = dataset.connect(
-    'sqlite:///./data/{s}-processing-{date}.sqlite'.format(s=SURVEY_NAME,
-                                                           date=date.today()))
+DB_PATH = './data/{s}-processing-{date}.sqlite'.format(s=SURVEY_NAME,
+                                                       date=date.today())
+db = dataset.connect('sqlite:///{path}'.format(path=DB_PATH))
+
+# declared column types for the typed loading mode, any other column is stored
+# as TEXT; timestamps are stored as integer epoch seconds (UTC)
+COLUMN_TYPES = {
+    'id': 'INTEGER',
+    'latitude': 'REAL',
+    'longitude': 'REAL',
+    'h_accuracy': 'REAL',
+    'v_accuracy': 'REAL',
+    'speed': 'REAL',
+    'altitude': 'REAL',
+    'timestamp': 'INTEGER',
+    'recorded_at': 'INTEGER'
+}
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF;',
+    'PRAGMA synchronous = OFF;',
+    'PRAGMA locking_mode = EXCLUSIVE;',
+    'PRAGMA temp_store = MEMORY;',
+    'PRAGMA cache_size = -262144;'
+]
 
 
 def load_table_from_csv(table_name, csv_fp):
@@ -20,8 +47,126 @@ def load_table_from_csv(table_name, csv_fp):
         db[table_name].insert_many(reader)
 
 
+def epoch_seconds(value):
+    dt = ciso8601.parse_datetime(value)
+    if dt.tzinfo is None:
+        return calendar.timegm(dt.timetuple())
+    return calendar.timegm(dt.utctimetuple())
+
+
+# find the function casting each .csv column to its declared type
+def column_casts(columns):
+    casts = []
+    for column in columns:
+        coltype = COLUMN_TYPES.get(column)
+        if column in ('timestamp', 'recorded_at'):
+            casts.append(epoch_seconds)
+        elif coltype == 'INTEGER':
+            casts.append(int)
+        elif coltype == 'REAL':
+            casts.append(float)
+        else:
+            casts.append(None)
+    return casts
+
+
+def cast_row(casts, row):
+    typed_row = []
+    for cast, value in zip(casts, row):
+        if cast is None:
+            typed_row.append(value)
+        elif value == '':
+            typed_row.append(None)
+        else:
+            typed_row.append(cast(value))
+    return typed_row
+
+
+# stream a .csv into a table with declared column types in chunks of rows,
+# committing a single transaction per chunk. Clustered tables with uuid and
+# timestamp columns are stored in (uuid, timestamp) order as the table's own
+# b-tree, so a user's rows and a scan of all users are read sequentially.
+def load_typed_table_from_csv(connection, table_name, csv_fp, chunk_rows=100000, clustered=False):
+    print('Creating {t} (typed)...'.format(t=table_name))
+    t0 = time.time()
+    connection.execute('DROP TABLE IF EXISTS "{t}";'.format(t=table_name))
+    with open(csv_fp, 'r', encoding='utf-8-sig') as csv_f:
+        reader = csv.reader(csv_f)
+        columns = next(reader)
+        coltypes = ['"{c}" {t}'.format(c=c, t=COLUMN_TYPES.get(c, 'TEXT')) for c in columns]
+        clustered = clustered and 'uuid' in columns and 'timestamp' in columns
+        number_rows = clustered and 'id' not in columns
+        if clustered:
+            # rows are numbered in .csv order when the export has no ids to keep
+            # duplicate timestamps distinct within the primary key
+            if number_rows:
+                coltypes.insert(0, '"id" INTEGER NOT NULL')
+            else:
+                coltypes[columns.index('id')] = '"id" INTEGER NOT NULL'
+            create_table_sql = '''CREATE TABLE "{t}" ({coltypes}, PRIMARY KEY ("uuid", "timestamp", "id")) WITHOUT ROWID;'''
+        else:
+            # match the autoincrementing primary key that dataset adds to its tables
+            if 'id' in columns:
+                coltypes[columns.index('id')] = '"id" INTEGER PRIMARY KEY'
+            else:
+                coltypes.insert(0, 'id INTEGER PRIMARY KEY')
+            create_table_sql = '''CREATE TABLE "{t}" ({coltypes});'''
+        connection.execute(create_table_sql.format(t=table_name, coltypes=', '.join(coltypes)))
+
+        casts = column_casts(columns)
+        if number_rows:
+            columns = ['id'] + columns
+            casts = [None] + casts
+            row_ids = itertools.count(1)
+            reader = ([str(next(row_ids))] + row for row in reader)
+        insert_sql = '''INSERT INTO "{t}" ({columns}) VALUES ({values});'''.format(
+            t=table_name,
+            columns=', '.join(['"{}"'.format(c) for c in columns]),
+            values=', '.join(['?'] * len(columns)))
+
+        num_rows = 0
+        while True:
+            chunk = [cast_row(casts, row) for row in itertools.islice(reader, chunk_rows)]
+            if not chunk:
+                break
+            with connection:
+                connection.executemany(insert_sql, chunk)
+            num_rows += len(chunk)
+
+    elapsed = time.time() - t0
+    print('Loaded {n} rows into {t} in {s:.1f} sec ({rate:.0f} rows/sec, {mb:.1f} MB/sec)'.format(
+        n=num_rows, t=table_name, s=elapsed,
+        rate=num_rows / elapsed if elapsed else 0.,
+        mb=os.path.getsize(csv_fp) / 1e6 / elapsed if elapsed else 0.))
+
+
+def create_typed_index(connection, table_name, index_columns):
+    index_name = 'ix_{t}_{c}'.format(t=table_name, c='_'.join(index_columns))
+    create_index_sql = '''CREATE INDEX IF NOT EXISTS "{i}" ON "{t}" ({columns});'''
+    connection.execute(create_index_sql.format(
+        i=index_name,
+        t=table_name,
+        columns=', '.join(['"{}"'.format(c) for c in index_columns])))
+    connection.commit()
+
+
 
 ### main
+parser = argparse.ArgumentParser(description='Load Itinerum .csv exports to SQLite.')
+parser.add_argument('--typed', action='store_true',
+                    help='stream the .csv files into typed columns with bulk-load settings')
+parser.add_argument('--chunk-rows', type=int, default=100000,
+                    help='rows inserted per transaction in typed mode (default: 100000)')
+parser.add_argument('--clustered', action='store_true',
+                    help='in typed mode, store coordinates and prompts in (uuid, timestamp) order')
+args = parser.parse_args()
+if args.clustered and not args.typed:
+    parser.error('--clustered requires --typed')
+if args.typed:
+    connection = sqlite3.connect(DB_PATH)
+    for pragma in BULK_LOAD_PRAGMAS:
+        connection.execute(pragma)
+
 # 1: Load data from .csv to .sqlite tables
 table_map = {
     'coordinates': '{s}-coordinates.csv'.format(s=SURVEY_NAME),
@@ -30,7 +175,11 @@ table_map = {
 }
 for table_name, csv_fn in table_map.items():
     csv_fp = os.path.join('data', csv_fn)
-    load_table_from_csv(table_name, csv_fp)
+    if args.typed:
+        load_typed_table_from_csv(connection, table_name, csv_fp, chunk_rows=args.chunk_rows,
+                                  clustered=args.clustered)
+    else:
+        load_table_from_csv(table_name, csv_fp)
 
 # 2: create indexes for speeding up queries
 index_map = {
@@ -39,7 +188,19 @@ index_map = {
     'survey_responses': ['uuid']
 }
 for table_name, index_columns in index_map.items():
+    # clustered tables are already stored in (uuid, timestamp) order
+    if args.clustered and index_columns == ['uuid', 'timestamp']:
+        continue
     print('Creating indexes on {t}...'.format(t=table_name))
-    db[table_name].create_index(index_columns)
+    t0 = time.time()
+    if args.typed:
+        create_typed_index(connection, table_name, index_columns)
+    else:
+        db[table_name].create_index(index_columns)
+    print('Created indexes on {t} in {s:.1f} sec'.format(t=table_name, s=time.time() - t0))
+
+if args.typed:
+    connection.execute('ANALYZE;')
+    connection.close()
 
 
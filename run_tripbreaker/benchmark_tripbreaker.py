@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Benchmark the tripbreaker stages and full run on synthetic users of
+# increasing size. Each size runs in a fresh process so that its peak memory
+# is measured alone, and results are saved as .json for comparing runs.
+import argparse
+from datetime import datetime
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from synthetic_itinerum import generate_points, load_metro_stations
+from tripbreaker import algorithm
+from tripbreaker.modules.track import PointTrack
+
+
+PARAMETERS = {
+    'break_interval_seconds': 360,
+    'subway_buffer_meters': 300,
+    'accuracy_cutoff_meters': 30
+}
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def count_points(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    if result is None:
+        return 0
+    if isinstance(result, dict):
+        return sum(len(group) for group in result.values())
+    return len(result)
+
+
+# peak resident memory of this process in megabytes
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 1024. ** 2
+    return peak / 1024.
+
+
+def input_points(num_points, seed, metro_stations, columnar):
+    points = generate_points(num_points, seed=seed, metro_stations=metro_stations)
+    if columnar:
+        return PointTrack.from_rows(points)
+    return points
+
+
+# run the same stages as `algorithm.run` one at a time, consuming generators so
+# each stage's cost is attributed to itself
+def run_stages(parameters, metro_stations, points, trace_memory=False):
+    state = {}
+
+    def setup(points):
+        zone = algorithm.survey_utm_zone(parameters, metro_stations)
+        state['stations'] = algorithm.survey_station_index(metro_stations, zone,
+                                                           parameters['subway_buffer_meters'])
+        return algorithm.project_points(points, zone=zone)
+
+    stages = [
+        ('process_utm', setup),
+        ('break_into_segments', lambda p: algorithm.break_into_segments(
+            p, cutoff=parameters['accuracy_cutoff_meters'], check_speed=60,
+            timegap=parameters['break_interval_seconds'])),
+        ('find_metro_transfers', lambda p: algorithm.find_metro_transfers(
+            state['stations'], p, buffer_m=parameters['subway_buffer_meters'])),
+        ('connect_by_velocity', algorithm.connect_by_velocity),
+        ('filter_single_points', algorithm.filter_single_points),
+        ('infer_missing_trips', lambda p: (p, algorithm.infer_missing_trips(state['stations'], p))),
+        ('merge_trips', lambda p: algorithm.merge_trips(p[0], p[1], state['stations'])),
+        ('summarize', algorithm.summarize)
+    ]
+
+    results = []
+    data = points
+    for name, func in stages:
+        points_in = count_points(data)
+        if trace_memory:
+            tracemalloc.start()
+        t0, c0 = time.perf_counter(), time.process_time()
+        data = func(data)
+        seconds, cpu_seconds = time.perf_counter() - t0, time.process_time() - c0
+        stage = {
+            'stage': name,
+            'seconds': seconds,
+            'cpu_seconds': cpu_seconds,
+            'points_in': points_in,
+            'points_out': count_points(data),
+            'points_per_second': points_in / seconds if seconds else None
+        }
+        if trace_memory:
+            stage['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+            tracemalloc.stop()
+        results.append(stage)
+    return results
+
+
+# benchmark a single synthetic user, called in a fresh process per size
+def benchmark_size(num_points, seed=0, columnar=False, trace_memory=False):
+    metro_stations = load_metro_stations()
+    t0 = time.perf_counter()
+    points = input_points(num_points, seed, metro_stations, columnar)
+    generate_seconds = time.perf_counter() - t0
+    input_rss_mb = peak_rss_mb()
+
+    # full run first so the process peak reflects `algorithm.run` alone
+    t0, c0 = time.perf_counter(), time.process_time()
+    trips, summaries = algorithm.run(PARAMETERS, metro_stations, points)
+    seconds, cpu_seconds = time.perf_counter() - t0, time.process_time() - c0
+    run_peak_rss_mb = peak_rss_mb()
+    num_trips = len(summaries) if summaries else 0
+    del trips, summaries, points
+
+    points = input_points(num_points, seed, metro_stations, columnar)
+    stages = run_stages(PARAMETERS, metro_stations, points, trace_memory=trace_memory)
+    return {
+        'points': num_points,
+        'seed': seed,
+        'columnar': columnar,
+        'generate_seconds': generate_seconds,
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'points_per_second': num_points / seconds if seconds else None,
+        'trips': num_trips,
+        'input_peak_rss_mb': input_rss_mb,
+        'peak_rss_mb': run_peak_rss_mb,
+        'stages': stages
+    }
+
+
+def benchmark_size_worker(args):
+    return benchmark_size(*args)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, seed=0, repeat=1, columnar=False, trace_memory=False):
+    results = {
+        'created_at': datetime.now().isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'parameters': PARAMETERS,
+        'runs': []
+    }
+    context = multiprocessing.get_context('spawn')
+    for num_points in sizes:
+        for _ in range(repeat):
+            pool = context.Pool(1, maxtasksperchild=1)
+            try:
+                result = pool.apply(benchmark_size_worker,
+                                    ((num_points, seed, columnar, trace_memory),))
+            finally:
+                pool.close()
+                pool.join()
+            print('{n} points: {s:.2f} sec ({rate:.0f} points/sec), peak {mb:.0f} MB'.format(
+                n=num_points, s=result['seconds'], rate=result['points_per_second'],
+                mb=result['peak_rss_mb']))
+            for stage in result['stages']:
+                print('    {stage:<28}{seconds:>10.3f} sec  {points_in:>9} -> {points_out}'.format(**stage))
+            results['runs'].append(result)
+    return results
+
+
+# run each size with and without decimation, checking that every trip starts and ends
+# at the same times with the same trip code, and reporting the share of points removed
+def verify_decimation(sizes, seed=0, columnar=False):
+    metro_stations = load_metro_stations()
+    parameters = dict(PARAMETERS, decimate=True)
+    zone = algorithm.survey_utm_zone(parameters, metro_stations)
+    unchanged = True
+    for num_points in sizes:
+        points = algorithm.project_points(input_points(num_points, seed, metro_stations, columnar), zone=zone)
+        kept = count_points(algorithm.decimate(points, **algorithm.decimation_settings(parameters)))
+
+        runs = []
+        for run_parameters in (PARAMETERS, parameters):
+            points = input_points(num_points, seed, metro_stations, columnar)
+            t0 = time.perf_counter()
+            _, summaries = algorithm.run(run_parameters, metro_stations, points)
+            runs.append((time.perf_counter() - t0, summaries or {}))
+        (seconds, summaries), (decimated_seconds, decimated) = runs
+
+        boundaries = [(s['start'], s['end']) for s in summaries.values()]
+        decimated_boundaries = [(s['start'], s['end']) for s in decimated.values()]
+        changed_codes = sum(1 for num, s in summaries.items()
+                            if num in decimated and decimated[num]['trip_code'] != s['trip_code'])
+        unchanged &= boundaries == decimated_boundaries and not changed_codes
+        print('{n} points: kept {k} ({r:.1%}), {s:.2f} -> {d:.2f} sec, {t} trips {b}, '
+              '{c} trip codes changed'.format(
+                  n=num_points, k=kept, r=float(kept) / num_points if num_points else 1.,
+                  s=seconds, d=decimated_seconds, t=len(summaries),
+                  b='unchanged' if boundaries == decimated_boundaries else 'CHANGED', c=changed_codes))
+    return unchanged
+
+
+# print the speedup of each size and stage against an earlier results file
+def compare(baseline, results):
+    def best(runs):
+        fastest = {}
+        for r in runs:
+            key = (r['points'], r['columnar'])
+            if key not in fastest or r['seconds'] < fastest[key]['seconds']:
+                fastest[key] = r
+        return fastest
+
+    before, after = best(baseline['runs']), best(results['runs'])
+    for key in sorted(set(before) & set(after)):
+        b, a = before[key], after[key]
+        print('{n} points{c}: {b:.2f} -> {a:.2f} sec ({x:.2f}x), peak {bm:.0f} -> {am:.0f} MB'.format(
+            n=key[0], c=' (columnar)' if key[1] else '', b=b['seconds'], a=a['seconds'],
+            x=b['seconds'] / a['seconds'], bm=b['peak_rss_mb'], am=a['peak_rss_mb']))
+        b_stages = {s['stage']: s for s in b['stages']}
+        for stage in a['stages']:
+            b_stage = b_stages.get(stage['stage'])
+            if b_stage and stage['seconds']:
+                print('    {name:<28}{x:>8.2f}x'.format(name=stage['stage'],
+                                                       x=b_stage['seconds'] / stage['seconds']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tripbreaker on synthetic users.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='points per synthetic user (default: 10000 100000 1000000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per size')
+    parser.add_argument('--columnar', action='store_true',
+                        help='pass points to the tripbreaker as a columnar PointTrack')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace the peak Python allocations of each stage (slower)')
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help='.json file to save results to')
+    parser.add_argument('--compare', help='earlier results .json to compare against')
+    parser.add_argument('--verify-decimation', action='store_true',
+                        help='check that decimating the points leaves the trip boundaries and '
+                             'codes unchanged')
+    args = parser.parse_args()
+
+    if args.verify_decimation:
+        unchanged = verify_decimation(args.sizes, seed=args.seed, columnar=args.columnar)
+        sys.exit(0 if unchanged else 1)
+
+    results = run(args.sizes, seed=args.seed, repeat=args.repeat, columnar=args.columnar,
+                  trace_memory=args.trace_memory)
+    with open(args.output, 'w') as json_f:
+        json.dump(results, json_f, indent=2)
+    print('Saved results to {fp}'.format(fp=args.output))
+    if args.compare:
+        with open(args.compare, 'r') as json_f:
+            compare(json.load(json_f), results)
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Local file outputs taking the place of PostGIS for the survey runner. The
+# writers share `postgis_copy.CopyWriter`'s interface (`write`, `commit`,
+# `close` and `report`) and add `create_table`, which takes the same column
+# declarations as the PostGIS tables. Geometries arrive as the hex EWKB made
+# by `postgis_copy` and are stored as GeoPackage geometry blobs or as the WKB
+# of a GeoParquet geometry column, both of which QGIS opens directly. A table's
+# first GEOMETRY column is its feature geometry; any further GEOMETRY columns,
+# such as the simplified trip lines, are GeoParquet geometry columns of their
+# own or, since a GeoPackage feature has one geometry, GeoPackage views of the
+# table named after the column.
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+import json
+import os
+import sqlite3
+import struct
+import time
+
+import postgis_copy
+
+
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10300
+WKB_TYPE_NAMES = {
+    postgis_copy.WKB_POINT: 'Point',
+    postgis_copy.WKB_LINESTRING: 'LineString'
+}
+# GeoPackage and Parquet types for the column types used by the PostGIS tables
+GPKG_TYPES = {
+    'SERIAL': 'INTEGER',
+    'INTEGER': 'INTEGER',
+    'FLOAT': 'DOUBLE',
+    'VARCHAR': 'TEXT',
+    'TEXT': 'TEXT',
+    'TIMESTAMP': 'DATETIME',
+    'GEOMETRY': 'GEOMETRY'
+}
+GPKG_SPATIAL_REF_SYS = [
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+    ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+     'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+     'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,'
+     'AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+     'AUTHORITY["EPSG","4326"]]',
+     'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid')
+]
+# triggers keeping a feature table's R-tree index current once the table has been
+# written, as given by the GeoPackage spatial index extension
+GPKG_RTREE_TRIGGERS = [
+    '''CREATE TRIGGER "rtree_{t}_{g}_insert" AFTER INSERT ON "{t}"
+       WHEN (new."{g}" NOT NULL AND NOT ST_IsEmpty(NEW."{g}"))
+       BEGIN
+         INSERT OR REPLACE INTO "rtree_{t}_{g}" VALUES (NEW."{i}", ST_MinX(NEW."{g}"),
+           ST_MaxX(NEW."{g}"), ST_MinY(NEW."{g}"), ST_MaxY(NEW."{g}"));
+       END;''',
+    '''CREATE TRIGGER "rtree_{t}_{g}_update1" AFTER UPDATE OF "{g}" ON "{t}"
+       WHEN OLD."{i}" = NEW."{i}" AND (NEW."{g}" NOTNULL AND NOT ST_IsEmpty(NEW."{g}"))
+       BEGIN
+         INSERT OR REPLACE INTO "rtree_{t}_{g}" VALUES (NEW."{i}", ST_MinX(NEW."{g}"),
+           ST_MaxX(NEW."{g}"), ST_MinY(NEW."{g}"), ST_MaxY(NEW."{g}"));
+       END;''',
+    '''CREATE TRIGGER "rtree_{t}_{g}_update2" AFTER UPDATE OF "{g}" ON "{t}"
+       WHEN OLD."{i}" = NEW."{i}" AND (NEW."{g}" IS NULL OR ST_IsEmpty(NEW."{g}"))
+       BEGIN
+         DELETE FROM "rtree_{t}_{g}" WHERE id = OLD."{i}";
+       END;''',
+    '''CREATE TRIGGER "rtree_{t}_{g}_update3" AFTER UPDATE ON "{t}"
+       WHEN OLD."{i}" != NEW."{i}" AND (NEW."{g}" NOTNULL AND NOT ST_IsEmpty(NEW."{g}"))
+       BEGIN
+         DELETE FROM "rtree_{t}_{g}" WHERE id = OLD."{i}";
+         INSERT OR REPLACE INTO "rtree_{t}_{g}" VALUES (NEW."{i}", ST_MinX(NEW."{g}"),
+           ST_MaxX(NEW."{g}"), ST_MinY(NEW."{g}"), ST_MaxY(NEW."{g}"));
+       END;''',
+    '''CREATE TRIGGER "rtree_{t}_{g}_update4" AFTER UPDATE ON "{t}"
+       WHEN OLD."{i}" != NEW."{i}" AND (NEW."{g}" IS NULL OR ST_IsEmpty(NEW."{g}"))
+       BEGIN
+         DELETE FROM "rtree_{t}_{g}" WHERE id IN (OLD."{i}", NEW."{i}");
+       END;''',
+    '''CREATE TRIGGER "rtree_{t}_{g}_delete" AFTER DELETE ON "{t}"
+       WHEN old."{g}" NOT NULL
+       BEGIN
+         DELETE FROM "rtree_{t}_{g}" WHERE id = OLD."{i}";
+       END;'''
+]
+
+
+# split a PostGIS column declaration such as 'uuid VARCHAR(36)' into its name, its
+# base type and whether it is the serial primary key
+def parse_coltype(coltype):
+    name, declared = coltype.split(' ', 1)
+    base = declared.split('(')[0].split(' ')[0].upper()
+    return name, base, base == 'SERIAL'
+
+
+# decode hex EWKB from `postgis_copy` into its SRID, geometry type and plain WKB
+def ewkb_to_wkb(ewkb_hex):
+    ewkb = bytes.fromhex(ewkb_hex)
+    geometry_type, srid = struct.unpack_from('<II', ewkb, 1)
+    geometry_type &= ~postgis_copy.EWKB_SRID_FLAG
+    return srid, geometry_type, ewkb[:1] + struct.pack('<I', geometry_type) + ewkb[9:]
+
+
+def wkb_envelope(geometry_type, wkb):
+    '''Return the (minx, maxx, miny, maxy) of a little-endian WKB point or linestring'''
+    if geometry_type == postgis_copy.WKB_POINT:
+        x, y = struct.unpack_from('<dd', wkb, 5)
+        return x, x, y, y
+    coordinates = array('d', wkb[9:])
+    xs, ys = coordinates[0::2], coordinates[1::2]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+# GeoPackage datetimes are UTC ISO 8601 strings ending with Z
+def gpkg_datetime(value):
+    if value is None:
+        return None
+    dt = datetime.fromisoformat(value) if isinstance(value, str) else value
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class GeoPackageWriter(object):
+    '''Writes the output tables as GeoPackage feature tables in a single .gpkg file.
+       Rows are buffered per table until `commit` inserts them, so that `rollback` can
+       discard them, and `commit` only ends the transaction once `batch_rows` rows have
+       been inserted since the last one. Each table's R-tree index is built in one pass
+       on `close`.'''
+    def __init__(self, gpkg_fp, batch_rows=50000):
+        self.gpkg_fp = gpkg_fp
+        self.batch_rows = batch_rows
+        # the connection is used by one thread at a time, but in pipeline mode that
+        # is the writer thread rather than the thread that opened it
+        self.connection = sqlite3.connect(gpkg_fp, check_same_thread=False)
+        self.connection.execute('PRAGMA application_id = {id};'.format(id=GPKG_APPLICATION_ID))
+        self.connection.execute('PRAGMA user_version = {v};'.format(v=GPKG_USER_VERSION))
+        self.connection.execute('PRAGMA synchronous = OFF;')
+        self.create_metadata_tables()
+        self.tables = {}
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.uncommitted_rows = 0
+        self.stats = {}
+        self.commit_seconds = 0.
+        self.index_seconds = 0.
+
+    def create_metadata_tables(self):
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+                srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+                organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL,
+                description TEXT);
+            CREATE TABLE IF NOT EXISTS gpkg_contents (
+                table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+                identifier TEXT UNIQUE, description TEXT DEFAULT '',
+                last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+                CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+            CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+                table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+                geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+                z TINYINT NOT NULL, m TINYINT NOT NULL,
+                CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+                CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+                CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+            CREATE TABLE IF NOT EXISTS gpkg_extensions (
+                table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+                definition TEXT NOT NULL, scope TEXT NOT NULL,
+                CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));''')
+        self.connection.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?);',
+                                    GPKG_SPATIAL_REF_SYS)
+        self.connection.commit()
+
+    def drop_table(self, table, views=()):
+        self.connection.execute('DROP TABLE IF EXISTS "rtree_{t}_geom";'.format(t=table))
+        for view in views:
+            self.connection.execute('DROP VIEW IF EXISTS "{v}";'.format(v=view))
+        self.connection.execute('DROP TABLE IF EXISTS "{t}";'.format(t=table))
+        for metadata_table in ('gpkg_extensions', 'gpkg_geometry_columns', 'gpkg_contents'):
+            for name in (table,) + tuple(views):
+                self.connection.execute('DELETE FROM {m} WHERE table_name = ?;'.format(m=metadata_table),
+                                        (name,))
+
+    def create_table(self, table, coltypes, drop=True):
+        '''Create a feature table from PostGIS column declarations, the SERIAL column
+           becoming the feature id and the first GEOMETRY column the feature geometry'''
+        columns, geometry_columns, fid_column = [], [], None
+        for coltype in coltypes:
+            name, base, serial = parse_coltype(coltype)
+            if serial:
+                fid_column = name
+                columns.append('"{c}" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL'.format(c=name))
+            else:
+                columns.append('"{c}" {t}'.format(c=name, t=GPKG_TYPES[base]))
+            if base == 'GEOMETRY':
+                geometry_columns.append(name)
+        views = OrderedDict(('{t}_{c}'.format(t=table, c=c), c) for c in geometry_columns[1:])
+        if drop:
+            self.drop_table(table, views)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "{t}" ({columns});'.format(
+            t=table, columns=', '.join(columns)))
+        self.tables[table] = {
+            'fid': fid_column,
+            'geometry': geometry_columns[0] if geometry_columns else None,
+            'views': views,
+            'columns': [parse_coltype(c)[0] for c in coltypes],
+            'datetimes': set(parse_coltype(c)[0] for c in coltypes if parse_coltype(c)[1] == 'TIMESTAMP'),
+            'srid': None,
+            'geometry_types': {c: set() for c in geometry_columns}
+        }
+        self.connection.commit()
+
+    def write(self, table, columns, rows):
+        columns = tuple(columns)
+        key = (table, columns)
+        if key not in self.buffers:
+            self.buffers[key] = []
+        buf = self.buffers[key]
+        num_rows = len(buf)
+        buf.extend(tuple(row) for row in rows)
+        self.buffered_rows += len(buf) - num_rows
+
+    def gpkg_geometry(self, table_info, column, ewkb_hex):
+        '''Convert hex EWKB to a GeoPackage geometry blob, linestrings carrying their
+           envelope in the header'''
+        srid, geometry_type, wkb = ewkb_to_wkb(ewkb_hex)
+        table_info['srid'] = srid
+        table_info['geometry_types'][column].add(geometry_type)
+        if geometry_type == postgis_copy.WKB_POINT:
+            return struct.pack('<2sBBi', b'GP', 0, 0b00000001, srid) + wkb
+        envelope = wkb_envelope(geometry_type, wkb)
+        return struct.pack('<2sBBi4d', b'GP', 0, 0b00000011, srid, *envelope) + wkb
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        for (table, columns), buf in self.buffers.items():
+            if not buf:
+                continue
+            t0 = time.time()
+            table_info = self.tables[table]
+            geometry_positions = [(i, c) for i, c in enumerate(columns) if c in table_info['geometry_types']]
+            datetime_positions = [i for i, c in enumerate(columns) if c in table_info['datetimes']]
+            rows = []
+            for row in buf:
+                row = list(row)
+                for i, column in geometry_positions:
+                    if row[i] is not None:
+                        row[i] = self.gpkg_geometry(table_info, column, row[i])
+                for i in datetime_positions:
+                    row[i] = gpkg_datetime(row[i])
+                rows.append(row)
+            insert_sql = 'INSERT INTO "{t}" ({columns}) VALUES ({values});'.format(
+                t=table,
+                columns=', '.join(['"{}"'.format(c) for c in columns]),
+                values=', '.join(['?'] * len(columns)))
+            self.connection.executemany(insert_sql, rows)
+            table_stats = self.stats.setdefault(table, {'rows': 0, 'seconds': 0.})
+            table_stats['rows'] += len(rows)
+            table_stats['seconds'] += time.time() - t0
+        self.uncommitted_rows += self.buffered_rows
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def commit(self):
+        self.flush()
+        if self.uncommitted_rows >= self.batch_rows:
+            self.end_transaction()
+
+    def rollback(self):
+        '''Discard the rows written since the last commit'''
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def end_transaction(self):
+        t0 = time.time()
+        self.connection.commit()
+        self.commit_seconds += time.time() - t0
+        self.uncommitted_rows = 0
+
+    def register_table(self, table):
+        '''Record a feature table and its extent in the GeoPackage metadata tables, along
+           with a view of the table for each of its further geometry columns, which shares
+           the table's extent since they are simplifications of its geometries'''
+        table_info = self.tables[table]
+        geometry_column = table_info['geometry']
+        srid = table_info['srid'] if table_info['srid'] is not None else 0
+        extent = self.connection.execute(
+            'SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy) FROM "rtree_{t}_{g}";'.format(
+                t=table, g=geometry_column)).fetchone()
+        features = [(table, geometry_column)]
+        for view, column in table_info['views'].items():
+            attributes = [c for c in table_info['columns'] if c not in table_info['geometry_types']]
+            self.connection.execute('CREATE VIEW IF NOT EXISTS "{v}" AS SELECT {a}, "{g}" FROM "{t}";'.format(
+                v=view, a=', '.join('"{c}"'.format(c=c) for c in attributes), g=column, t=table))
+            features.append((view, column))
+
+        for name, column in features:
+            geometry_types = table_info['geometry_types'][column]
+            geometry_type_name = 'GEOMETRY'
+            if len(geometry_types) == 1:
+                geometry_type_name = WKB_TYPE_NAMES[next(iter(geometry_types))].upper()
+            self.connection.execute('INSERT OR REPLACE INTO gpkg_contents (table_name, data_type, identifier, '
+                                    'min_x, min_y, max_x, max_y, srs_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                                    (name, 'features', name) + tuple(extent) + (srid,))
+            self.connection.execute('INSERT OR REPLACE INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, 0, 0);',
+                                    (name, column, geometry_type_name, srid))
+
+    def build_rtree(self, table):
+        '''Index a feature table's envelopes in one pass once its rows are written, adding
+           the triggers that keep the index current for later edits afterwards'''
+        t0 = time.time()
+        table_info = self.tables[table]
+        fid, geometry_column = table_info['fid'], table_info['geometry']
+        rtree = 'rtree_{t}_{g}'.format(t=table, g=geometry_column)
+        self.connection.execute('DROP TABLE IF EXISTS "{r}";'.format(r=rtree))
+        self.connection.execute('CREATE VIRTUAL TABLE "{r}" USING rtree(id, minx, maxx, miny, maxy);'.format(
+            r=rtree))
+        envelopes = []
+        select_sql = 'SELECT "{i}", "{g}" FROM "{t}" WHERE "{g}" IS NOT NULL;'.format(
+            i=fid, g=geometry_column, t=table)
+        for feature_id, blob in self.connection.execute(select_sql):
+            flags = blob[3]
+            if flags & 0b00001110:
+                envelope = struct.unpack_from('<4d', blob, 8)
+            else:
+                x, y = struct.unpack_from('<dd', blob, 8 + 5)
+                envelope = (x, x, y, y)
+            envelopes.append((feature_id,) + envelope)
+        self.connection.executemany('INSERT INTO "{r}" VALUES (?, ?, ?, ?, ?);'.format(r=rtree),
+                                    envelopes)
+        for trigger_sql in GPKG_RTREE_TRIGGERS:
+            self.connection.execute(trigger_sql.format(t=table, g=geometry_column, i=fid))
+        self.connection.execute('INSERT OR REPLACE INTO gpkg_extensions VALUES (?, ?, ?, ?, ?);',
+                                (table, geometry_column, 'gpkg_rtree_index',
+                                 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only'))
+        self.index_seconds += time.time() - t0
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.flush()
+        for table, table_info in self.tables.items():
+            if table_info['geometry'] is not None:
+                self.build_rtree(table)
+                self.register_table(table)
+        self.end_transaction()
+        self.connection.close()
+        self.connection = None
+
+    def report(self):
+        lines = []
+        for table, table_stats in sorted(self.stats.items()):
+            rate = table_stats['rows'] / table_stats['seconds'] if table_stats['seconds'] else 0.
+            lines.append('{table}: {rows} rows in {s:.2f} sec ({rate:.0f} rows/sec)'.format(
+                table=table, rows=table_stats['rows'], s=table_stats['seconds'], rate=rate))
+        lines.append('commits: {s:.2f} sec'.format(s=self.commit_seconds))
+        lines.append('spatial indexes: {s:.2f} sec'.format(s=self.index_seconds))
+        return '\n'.join(lines)
+
+
+class GeoParquetWriter(object):
+    '''Writes each output table as a GeoParquet file in a directory, buffering rows
+       and writing a row group once a `commit` finds `batch_rows` rows waiting, so
+       that `rollback` can discard the rows written since the last commit. Geometries
+       are stored as WKB and the file's "geo" metadata is written with its footer on
+       `close`.'''
+    def __init__(self, parquet_dir, batch_rows=50000):
+        # imported here so that pyarrow is only needed for GeoParquet output
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.parquet_dir = parquet_dir
+        self.batch_rows = batch_rows
+        os.makedirs(parquet_dir, exist_ok=True)
+        self.tables = {}
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.committed_rows = {}
+        self.stats = {}
+
+    def arrow_type(self, base):
+        pa = self.pa
+        return {
+            'SERIAL': pa.int64(),
+            'INTEGER': pa.int64(),
+            'FLOAT': pa.float64(),
+            'VARCHAR': pa.string(),
+            'TEXT': pa.string(),
+            'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+            'GEOMETRY': pa.binary()
+        }[base]
+
+    def create_table(self, table, coltypes, drop=True):
+        fp = os.path.join(self.parquet_dir, '{t}.parquet'.format(t=table))
+        if not drop and os.path.exists(fp):
+            raise ValueError('{fp} already exists and GeoParquet tables cannot be '
+                             'appended to'.format(fp=fp))
+        fields, geometry_columns, serial_column = [], [], None
+        for coltype in coltypes:
+            name, base, serial = parse_coltype(coltype)
+            fields.append(self.pa.field(name, self.arrow_type(base)))
+            if serial:
+                serial_column = name
+            if base == 'GEOMETRY':
+                geometry_columns.append(name)
+        self.tables[table] = {
+            'fp': fp,
+            'schema': self.pa.schema(fields),
+            'serial': serial_column,
+            'geometry': geometry_columns[0] if geometry_columns else None,
+            'next_id': 1,
+            'writer': None,
+            'srid': None,
+            'geometry_types': {c: set() for c in geometry_columns},
+            'bbox': {c: None for c in geometry_columns}
+        }
+
+    def write(self, table, columns, rows):
+        columns = tuple(columns)
+        key = (table, columns)
+        if key not in self.buffers:
+            self.buffers[key] = []
+        buf = self.buffers[key]
+        num_rows = len(buf)
+        buf.extend(tuple(row) for row in rows)
+        self.buffered_rows += len(buf) - num_rows
+
+    def geo_metadata(self, table_info):
+        srid = table_info['srid']
+        columns = OrderedDict()
+        for name, geometry_types in table_info['geometry_types'].items():
+            column = {
+                'encoding': 'WKB',
+                'geometry_types': sorted(WKB_TYPE_NAMES[t] for t in geometry_types)
+            }
+            # GeoParquet's default CRS is longitude/latitude on WGS 84
+            if srid not in (None, 4326):
+                column['crs'] = {'id': {'authority': 'EPSG', 'code': srid}}
+            if table_info['bbox'][name] is not None:
+                column['bbox'] = list(table_info['bbox'][name])
+            columns[name] = column
+        return {'version': '1.0.0', 'primary_column': table_info['geometry'], 'columns': columns}
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        pa = self.pa
+        for (table, columns), buf in self.buffers.items():
+            if not buf:
+                continue
+            t0 = time.time()
+            table_info = self.tables[table]
+            schema = table_info['schema']
+            values = dict(zip(columns, zip(*buf)))
+            if table_info['serial'] is not None and table_info['serial'] not in values:
+                next_id = table_info['next_id']
+                values[table_info['serial']] = range(next_id, next_id + len(buf))
+                table_info['next_id'] = next_id + len(buf)
+            for geometry_column in table_info['geometry_types']:
+                if geometry_column not in values:
+                    continue
+                geometries = []
+                for ewkb_hex in values[geometry_column]:
+                    if ewkb_hex is None:
+                        geometries.append(None)
+                        continue
+                    srid, geometry_type, wkb = ewkb_to_wkb(ewkb_hex)
+                    table_info['srid'] = srid
+                    table_info['geometry_types'][geometry_column].add(geometry_type)
+                    envelope = wkb_envelope(geometry_type, wkb)
+                    bbox = table_info['bbox'][geometry_column]
+                    table_info['bbox'][geometry_column] = envelope[::2] + envelope[1::2] if bbox is None else (
+                        min(bbox[0], envelope[0]), min(bbox[1], envelope[2]),
+                        max(bbox[2], envelope[1]), max(bbox[3], envelope[3]))
+                    geometries.append(wkb)
+                values[geometry_column] = geometries
+
+            arrays = []
+            for field in schema:
+                column = values.get(field.name)
+                if column is None:
+                    arrays.append(pa.nulls(len(buf), type=field.type))
+                elif pa.types.is_timestamp(field.type):
+                    # ISO 8601 strings with their UTC offsets
+                    arrays.append(pa.array(column, type=pa.string()).cast(field.type))
+                else:
+                    arrays.append(pa.array(list(column), type=field.type))
+            batch = pa.Table.from_arrays(arrays, schema=schema)
+            if table_info['writer'] is None:
+                table_info['writer'] = self.pq.ParquetWriter(table_info['fp'], schema)
+            table_info['writer'].write_table(batch)
+            table_stats = self.stats.setdefault(table, {'rows': 0, 'seconds': 0.})
+            table_stats['rows'] += len(buf)
+            table_stats['seconds'] += time.time() - t0
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    # rows only reach disk as row groups, so a commit waits for a full batch
+    def commit(self):
+        if self.buffered_rows >= self.batch_rows:
+            self.flush()
+        self.committed_rows = {key: len(buf) for key, buf in self.buffers.items()}
+
+    def rollback(self):
+        '''Discard the rows written since the last commit'''
+        for key, buf in self.buffers.items():
+            del buf[self.committed_rows.get(key, 0):]
+        self.buffered_rows = sum(len(buf) for buf in self.buffers.values())
+
+    def close(self):
+        self.flush()
+        for table, table_info in self.tables.items():
+            writer = table_info['writer']
+            if writer is None:
+                writer = self.pq.ParquetWriter(table_info['fp'], table_info['schema'])
+            if table_info['geometry'] is not None:
+                writer.add_key_value_metadata({'geo': json.dumps(self.geo_metadata(table_info))})
+            writer.close()
+            table_info['writer'] = None
+
+    def report(self):
+        lines = []
+        for table, table_stats in sorted(self.stats.items()):
+            rate = table_stats['rows'] / table_stats['seconds'] if table_stats['seconds'] else 0.
+            lines.append('{table}: {rows} rows in {s:.2f} sec ({rate:.0f} rows/sec)'.format(
+                table=table, rows=table_stats['rows'], s=table_stats['seconds'], rate=rate))
+        return '\n'.join(lines)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Per-user state for incremental tail reprocessing. After a run, the last trip
+# that new points can no longer change is recorded as "closed"; the next run
+# re-fetches points from the start of that trip (kept as context so the missing
+# trip and cold start rules see the trip before the tail), runs the tripbreaker
+# on the tail and replaces only the trips that follow the closed one.
+import hashlib
+import json
+
+from tripbreaker.modules.station_index import StationIndex
+
+
+# codes for trips made up only of inferred (missing) rows
+MISSING_TRIP_CODES = (101, 102)
+# state fields describing the closed trip and where to rewind to
+CLOSING_FIELDS = ('closed_trip_id', 'closed_start', 'closed_end',
+                  'closed_segment_group', 'rewind_timestamp')
+
+
+def fingerprint(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def parameters_fingerprint(parameters):
+    return fingerprint(parameters)
+
+
+def stations_fingerprint(metro_stations):
+    # a compiled station index fingerprints the same as the stations it was compiled from
+    if isinstance(metro_stations, StationIndex):
+        metro_stations = metro_stations.records
+    return fingerprint([[round(float(s['latitude']), 7), round(float(s['longitude']), 7)]
+                        for s in metro_stations])
+
+
+# find the closed trip: the detected trip before the last detected trip, since
+# the last trip can still absorb a single point, be velocity-linked or gain a cold
+# start from the points that follow it. The detected trip before the closed trip
+# is kept as context when rewinding so the closed trip is linked the same way.
+def closing_trip(trips, summaries):
+    detected = [num for num in sorted(summaries)
+                if summaries[num]['trip_code'] not in MISSING_TRIP_CODES]
+    if len(detected) < 3:
+        return None
+    context_num, closed_num = detected[-3], detected[-2]
+    context = observed_points(trips[context_num])
+    closed = observed_points(trips[closed_num])
+    if not context or not closed:
+        return None
+    return {
+        'closed_trip_id': closed_num,
+        'closed_start': closed[0]['timestamp'],
+        'closed_end': closed[-1]['timestamp'],
+        'closed_segment_group': max(p['segment_group'] for p in closed),
+        'rewind_timestamp': context[0]['timestamp']
+    }
+
+
+# points of a trip recorded by the device, without inferred cold start or
+# missing trip rows
+def observed_points(trip):
+    return [p for p in trip if p.get('segment_group')]
+
+
+# build the state stored for a user, `closing` may be the result of `closing_trip`
+# or a previous state whose closed trip is still the latest one
+def build_state(mobile_uuid, last_timestamp, closing, parameters_fp, stations_fp):
+    closing = closing or {}
+    state = {
+        'uuid': mobile_uuid,
+        'last_timestamp': last_timestamp,
+        'parameters_fingerprint': parameters_fp,
+        'stations_fingerprint': stations_fp
+    }
+    for field in CLOSING_FIELDS:
+        state[field] = closing.get(field)
+    return state
+
+
+# test whether a stored state can be resumed with the current run's settings
+def can_resume(state, parameters_fp, stations_fp):
+    return bool(state and
+                state.get('closed_trip_id') and
+                state.get('rewind_timestamp') and
+                state.get('parameters_fingerprint') == parameters_fp and
+                state.get('stations_fingerprint') == stations_fp)
+
+
+# renumber the trips detected on a tail into the user's stored numbering; only
+# the trips numbered after the closed trip replace stored ones. Returns None when
+# the tail did not reproduce the closed trip, in which case the user must be
+# reprocessed in full.
+def renumber_tail(state, trips, summaries):
+    closed_num = None
+    for num in sorted(trips):
+        observed = observed_points(trips[num])
+        if observed and observed[-1]['timestamp'] == state['closed_end']:
+            closed_num = num
+            break
+    if closed_num is None or observed[0]['timestamp'] != state['closed_start']:
+        return None
+    trip_offset = state['closed_trip_id'] - closed_num
+    segment_offset = state['closed_segment_group'] - max(p['segment_group'] for p in observed)
+
+    tail_trips, tail_summaries = {}, {}
+    for num in sorted(trips):
+        for point in trips[num]:
+            point['trip'] = num + trip_offset
+            if point.get('segment_group'):
+                point['segment_group'] += segment_offset
+        summaries[num]['trip_id'] = num + trip_offset
+        tail_trips[num + trip_offset] = trips[num]
+        tail_summaries[num + trip_offset] = summaries[num]
+    return tail_trips, tail_summaries
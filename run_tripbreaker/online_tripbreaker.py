@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Push-based tripbreaker for live point ingestion. Points are pushed for a user
+# as they arrive and the tripbreaker is rerun on a short buffer holding the
+# context trip, the last closed trip and the open points after it. Trips up to
+# the closed trip are emitted once, numbered as a batch `algorithm.run` over the
+# user's full history would number them, using the same closing rules as the
+# incremental survey runner.
+from datetime import datetime
+
+import incremental_state
+from tripbreaker import algorithm
+
+
+class OnlineTripBreaker(object):
+    '''Detects a single user's trips from points pushed in timestamp order. `push`
+       returns the trips and summaries finalized by the new points, `flush` the rest
+       once the user has stopped recording.'''
+    def __init__(self, parameters, metro_stations, mobile_uuid=None):
+        self.parameters = parameters
+        self.metro_stations = metro_stations
+        self.uuid = mobile_uuid
+        self.fingerprints = (incremental_state.parameters_fingerprint(parameters),
+                             incremental_state.stations_fingerprint(metro_stations))
+        self.buffer = []
+        self.closing = None
+        self.last_timestamp = None
+        self.last_accurate_timestamp = None
+        self.pending = False
+
+    # add points and return the trips they finalized, which is usually nothing
+    # until a gap of more than `break_interval_seconds` has been recorded
+    def push(self, points):
+        if isinstance(points, dict):
+            points = [points]
+        for point in sorted(points, key=lambda p: p['timestamp']):
+            if self.last_timestamp is not None and point['timestamp'] < self.last_timestamp:
+                raise ValueError('Point at {t} is older than the last point pushed ({last})'.format(
+                    t=point['timestamp'], last=self.last_timestamp))
+            self.buffer.append(dict(point))
+            self.last_timestamp = point['timestamp']
+
+            # only a gap between accurate points can break a segment
+            if point['h_accuracy'] <= self.parameters['accuracy_cutoff_meters']:
+                if self.last_accurate_timestamp is not None:
+                    gap = (point['timestamp'] - self.last_accurate_timestamp).total_seconds()
+                    if gap > self.parameters['break_interval_seconds']:
+                        self.pending = True
+                self.last_accurate_timestamp = point['timestamp']
+
+        if not self.pending:
+            return {}, {}
+        self.pending = False
+        return self.emit()
+
+    # emit every trip remaining in the buffer, as when the user's recording ends
+    def flush(self):
+        trips, summaries = self.run_buffer()
+        if trips is None:
+            return {}, {}
+        if self.closing:
+            tail = incremental_state.renumber_tail(self.closing, trips, summaries)
+            if tail is None:
+                raise ValueError('Buffer for {uuid} no longer reproduces its closed trip'.format(
+                    uuid=self.uuid))
+            trips, summaries = tail
+            closed_trip_id = self.closing['closed_trip_id']
+            trips = {num: trip for num, trip in trips.items() if num > closed_trip_id}
+            summaries = {num: s for num, s in summaries.items() if num > closed_trip_id}
+        self.buffer = []
+        self.closing = None
+        return trips, summaries
+
+    def run_buffer(self):
+        if not self.buffer:
+            return None, None
+        # the tripbreaker labels and moves points in place so it runs on copies
+        points = [dict(p) for p in self.buffer]
+        return algorithm.run(self.parameters, self.metro_stations, points)
+
+    # rerun the buffer, emit the trips closed since the last run and drop the
+    # points before the new context trip. A rerun that does not reproduce the
+    # closed trip emits nothing and keeps the buffer to retry with later points.
+    def emit(self):
+        trips, summaries = self.run_buffer()
+        if not trips:
+            return {}, {}
+        last_closed_id = 0
+        if self.closing:
+            tail = incremental_state.renumber_tail(self.closing, trips, summaries)
+            if tail is None:
+                return {}, {}
+            trips, summaries = tail
+            last_closed_id = self.closing['closed_trip_id']
+
+        closing = incremental_state.closing_trip(trips, summaries)
+        if not closing or closing['closed_trip_id'] <= last_closed_id:
+            return {}, {}
+        closed_trip_id = closing['closed_trip_id']
+        finalized = [num for num in sorted(trips) if last_closed_id < num <= closed_trip_id]
+
+        self.closing = closing
+        self.buffer = [p for p in self.buffer if p['timestamp'] >= closing['rewind_timestamp']]
+        return ({num: trips[num] for num in finalized},
+                {num: summaries[num] for num in finalized if num in summaries})
+
+    # serializable state for resuming after a restart, timestamps are stored as
+    # ISO 8601 strings so that the state can be saved as .json
+    def state(self):
+        closing = {}
+        for field, value in (self.closing or {}).items():
+            closing[field] = value.isoformat() if isinstance(value, datetime) else value
+        buffer = []
+        for p in self.buffer:
+            buffer.append(dict(p, timestamp=p['timestamp'].isoformat()))
+        return {
+            'uuid': self.uuid,
+            'parameters_fingerprint': self.fingerprints[0],
+            'stations_fingerprint': self.fingerprints[1],
+            'closing': closing or None,
+            'last_timestamp': self.last_timestamp.isoformat() if self.last_timestamp else None,
+            'pending': self.pending,
+            'buffer': buffer
+        }
+
+    @classmethod
+    def from_state(cls, state, parameters, metro_stations):
+        breaker = cls(parameters, metro_stations, mobile_uuid=state['uuid'])
+        if (state['parameters_fingerprint'], state['stations_fingerprint']) != breaker.fingerprints:
+            raise ValueError('State for {uuid} was saved with different parameters or '
+                             'metro stations'.format(uuid=state['uuid']))
+        if state['closing']:
+            breaker.closing = {}
+            for field, value in state['closing'].items():
+                if field in ('closed_start', 'closed_end', 'rewind_timestamp'):
+                    value = datetime.fromisoformat(value)
+                breaker.closing[field] = value
+        if state['last_timestamp']:
+            breaker.last_timestamp = datetime.fromisoformat(state['last_timestamp'])
+        breaker.pending = state['pending']
+        for p in state['buffer']:
+            p = dict(p, timestamp=datetime.fromisoformat(p['timestamp']))
+            breaker.buffer.append(p)
+            if p['h_accuracy'] <= parameters['accuracy_cutoff_meters']:
+                breaker.last_accurate_timestamp = p['timestamp']
+        return breaker
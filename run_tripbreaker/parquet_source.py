@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Input source reading the Parquet files written by `load_csvs_to_parquet.py`
+# in place of the SQLite input database. Files are memory-mapped and a user's
+# coordinates are sliced from their row group straight into the typed arrays
+# of a PointTrack, without a dictionary or string cast per point.
+from datetime import datetime, timezone
+import json
+import os
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from tripbreaker.modules.track import INPUT_COLUMNS, PointTrack, datetime_to_epoch
+
+
+USERS_METADATA_KEY = b'itinerum_users'
+FLOAT_COLUMNS = ('latitude', 'longitude', 'h_accuracy', 'v_accuracy', 'speed', 'altitude')
+TIMESTAMP_COLUMNS = ('timestamp', 'recorded_at')
+
+
+class ParquetSource(object):
+    '''Reads users from a directory holding coordinates.parquet, prompt_responses.parquet
+       and survey_responses.parquet. The last row group read from each file is kept so
+       that users sharing a row group only have it read once.'''
+    def __init__(self, parquet_dir):
+        self.parquet_dir = parquet_dir
+        self.files = {}
+        self.users = {}
+        self.cached_groups = {}
+
+    def open_table(self, table_name):
+        if table_name not in self.files:
+            fp = os.path.join(self.parquet_dir, '{t}.parquet'.format(t=table_name))
+            parquet_f = pq.ParquetFile(fp, memory_map=True)
+            metadata = parquet_f.schema_arrow.metadata or {}
+            if USERS_METADATA_KEY not in metadata:
+                raise ValueError('{fp} has no user index, convert it with '
+                                 'load_csvs_to_parquet.py'.format(fp=fp))
+            self.files[table_name] = parquet_f
+            self.users[table_name] = json.loads(metadata[USERS_METADATA_KEY].decode('utf-8'))
+        return self.files[table_name]
+
+    def read_user(self, table_name, mobile_uuid, columns=None):
+        '''Return a user's rows of a table as a pyarrow Table, empty for unknown users'''
+        parquet_f = self.open_table(table_name)
+        columns = [c for c in columns if c in parquet_f.schema_arrow.names] if columns else None
+        if mobile_uuid not in self.users[table_name]:
+            return parquet_f.schema_arrow.empty_table().select(columns or parquet_f.schema_arrow.names)
+        row_group, offset, num_rows = self.users[table_name][mobile_uuid]
+        key = (row_group, tuple(columns) if columns else None)
+        cached = self.cached_groups.get(table_name)
+        if cached is None or cached[0] != key:
+            cached = (key, parquet_f.read_row_group(row_group, columns=columns))
+            self.cached_groups[table_name] = cached
+        return cached[1].slice(offset, num_rows)
+
+    def uuids(self):
+        '''The uuids of the survey's respondents, sorted'''
+        parquet_f = self.open_table('survey_responses')
+        column = parquet_f.read(columns=['uuid']).column('uuid').to_pylist()
+        return list(dict.fromkeys(u for u in column if u))
+
+    def point_counts(self):
+        self.open_table('coordinates')
+        return {uuid: user[2] for uuid, user in self.users['coordinates'].items()}
+
+    def coordinates(self, mobile_uuid, since=None):
+        '''Return a user's coordinates as a PointTrack, optionally only those recorded
+           from a timestamp onwards. Missing numbers are read as 0. like the SQLite input.'''
+        table = self.read_user('coordinates', mobile_uuid, columns=list(INPUT_COLUMNS))
+        arrays = {}
+        for name in table.column_names:
+            column = table.column(name)
+            if name in FLOAT_COLUMNS and column.null_count:
+                column = column.fill_null(0.)
+            arrays[name] = column.combine_chunks().to_numpy(zero_copy_only=False)
+        if since is not None:
+            # rows are sorted by timestamp within each user
+            start = np.searchsorted(arrays['timestamp'], datetime_to_epoch(since), side='left')
+            arrays = {name: values[start:] for name, values in arrays.items()}
+        return PointTrack.from_arrays(arrays, uuid=mobile_uuid, tzinfo=timezone.utc)
+
+    def prompts(self, mobile_uuid):
+        '''Return a user's prompt responses as dictionaries cast to their Python types'''
+        rows = self.read_user('prompt_responses', mobile_uuid).to_pylist()
+        for r in rows:
+            for col in TIMESTAMP_COLUMNS:
+                if r.get(col) is not None:
+                    r[col] = datetime.fromtimestamp(r[col], tz=timezone.utc)
+            for col in FLOAT_COLUMNS:
+                if col in r and r[col] is None:
+                    r[col] = 0.
+            r['uuid'] = mobile_uuid
+        return rows
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Bulk writer streaming rows to PostGIS with COPY ... FROM STDIN and
+# geometries encoded client-side as hex EWKB
+import argparse
+import io
+import struct
+import time
+
+
+WKB_POINT = 1
+WKB_LINESTRING = 2
+EWKB_SRID_FLAG = 0x20000000
+
+
+# encode a lon/lat point as little-endian hex EWKB with an embedded SRID
+def ewkb_point(lon, lat, srid):
+    return struct.pack('<BIIdd', 1, WKB_POINT | EWKB_SRID_FLAG, srid, lon, lat).hex()
+
+
+# encode a sequence of lon/lat pairs as a little-endian hex EWKB linestring
+def ewkb_linestring(coordinates, srid):
+    header = struct.pack('<BIII', 1, WKB_LINESTRING | EWKB_SRID_FLAG, srid, len(coordinates))
+    body = struct.pack('<{n}d'.format(n=len(coordinates) * 2),
+                       *[c for pair in coordinates for c in pair])
+    return (header + body).hex()
+
+
+# format a value for PostgreSQL's COPY text format
+def copy_text(value):
+    if value is None:
+        return '\\N'
+    value = str(value)
+    if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+        value = (value.replace('\\', '\\\\')
+                      .replace('\t', '\\t')
+                      .replace('\n', '\\n')
+                      .replace('\r', '\\r'))
+    return value
+
+
+class CopyWriter(object):
+    '''Buffers rows per table and streams them to the database with COPY once
+       `batch_rows` rows are waiting or when `commit` is called. The raw DBAPI
+       connection is only opened on the first flush.'''
+    def __init__(self, db, batch_rows=50000):
+        self.db = db
+        self.batch_rows = batch_rows
+        self.connection = None
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.stats = {}
+        self.commit_seconds = 0.
+
+    def write(self, table, columns, rows):
+        columns = tuple(columns)
+        key = (table, columns)
+        if key not in self.buffers:
+            self.buffers[key] = [io.StringIO(), 0]
+        buf = self.buffers[key]
+        num_rows = 0
+        for row in rows:
+            buf[0].write('\t'.join([copy_text(v) for v in row]))
+            buf[0].write('\n')
+            num_rows += 1
+        buf[1] += num_rows
+        self.buffered_rows += num_rows
+        if self.buffered_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        if self.connection is None:
+            self.connection = self.db.engine.raw_connection()
+        cursor = self.connection.cursor()
+        for (table, columns), (buf, num_rows) in self.buffers.items():
+            if not num_rows:
+                continue
+            t0 = time.time()
+            buf.seek(0)
+            copy_sql = 'COPY {table} ({columns}) FROM STDIN'.format(table=table,
+                                                                   columns=', '.join(columns))
+            cursor.copy_expert(copy_sql, buf)
+            table_stats = self.stats.setdefault(table, {'rows': 0, 'seconds': 0.})
+            table_stats['rows'] += num_rows
+            table_stats['seconds'] += time.time() - t0
+        cursor.close()
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def execute(self, sql, params=None):
+        '''Run a statement within the same transaction as the buffered rows,
+           flushing them first so that statements and COPYs apply in order'''
+        self.flush()
+        if self.connection is None:
+            self.connection = self.db.engine.raw_connection()
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        cursor.close()
+
+    def commit(self):
+        self.flush()
+        if self.connection is not None:
+            t0 = time.time()
+            self.connection.commit()
+            self.commit_seconds += time.time() - t0
+
+    def rollback(self):
+        '''Discard the buffered rows and roll back the rows and statements sent
+           since the last commit'''
+        self.buffers = {}
+        self.buffered_rows = 0
+        if self.connection is not None:
+            self.connection.rollback()
+
+    def close(self):
+        self.commit()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def report(self):
+        lines = []
+        for table, table_stats in sorted(self.stats.items()):
+            rate = table_stats['rows'] / table_stats['seconds'] if table_stats['seconds'] else 0.
+            lines.append('{table}: {rows} rows in {s:.2f} sec ({rate:.0f} rows/sec)'.format(
+                table=table, rows=table_stats['rows'], s=table_stats['seconds'], rate=rate))
+        lines.append('commits: {s:.2f} sec'.format(s=self.commit_seconds))
+        return '\n'.join(lines)
+
+
+# compare per-row INSERT statements against the COPY writer on a scratch table
+def benchmark(db_uri, num_rows, srid=4326):
+    import dataset
+    db = dataset.connect(db_uri)
+    db.query('DROP TABLE IF EXISTS copy_benchmark;')
+    db.query('''CREATE TABLE copy_benchmark (id SERIAL PRIMARY KEY, uuid VARCHAR(36),
+                latitude FLOAT, longitude FLOAT, timestamp TIMESTAMP WITH TIME ZONE,
+                geom GEOMETRY);''')
+    rows = []
+    for i in range(num_rows):
+        lat, lon = 45.5 + i * 1e-6, -73.6 + i * 1e-6
+        rows.append(('00000000-0000-0000-0000-000000000000', lat, lon,
+                     '2017-09-01T08:00:00+00:00'))
+
+    insert_rows = min(num_rows, 10000)
+    t0 = time.time()
+    for uuid, lat, lon, timestamp in rows[:insert_rows]:
+        db.query('''INSERT INTO copy_benchmark (uuid, latitude, longitude, timestamp, geom)
+                    VALUES ('{u}', '{lat}', '{lon}', '{ts}',
+                            ST_GeomFromText('POINT({lon} {lat})', {srid}));'''.format(
+            u=uuid, lat=lat, lon=lon, ts=timestamp, srid=srid))
+    insert_seconds = time.time() - t0
+    print('INSERT: {n} rows in {s:.2f} sec ({rate:.0f} rows/sec)'.format(
+        n=insert_rows, s=insert_seconds, rate=insert_rows / insert_seconds))
+
+    writer = CopyWriter(db)
+    t0 = time.time()
+    writer.write('copy_benchmark', ('uuid', 'latitude', 'longitude', 'timestamp', 'geom'),
+                 (r + (ewkb_point(r[2], r[1], srid),) for r in rows))
+    writer.close()
+    copy_seconds = time.time() - t0
+    print('COPY: {n} rows in {s:.2f} sec ({rate:.0f} rows/sec)'.format(
+        n=num_rows, s=copy_seconds, rate=num_rows / copy_seconds))
+    db.query('DROP TABLE copy_benchmark;')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark COPY against per-row INSERTs.')
+    parser.add_argument('db_uri', help='PostGIS database, e.g. postgresql://localhost/tripbreaking')
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+    benchmark(args.db_uri, args.rows)
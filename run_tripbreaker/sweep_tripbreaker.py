@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Run the tripbreaker over a grid of parameters and report the trips found by
+# each combination. Every stage's output is cached by the parameters it depends
+# on: a user is projected once, filtered once per accuracy cutoff and segmented
+# once per cutoff and break interval, so that only the stages after
+# segmentation are repeated for every combination. Users are spread across
+# processes and each evaluates the whole grid to share its cached stages.
+import argparse
+from collections import Counter, OrderedDict
+import csv
+import itertools
+import multiprocessing
+import time
+import traceback
+
+import numpy as np
+
+from synthetic_itinerum import generate_points
+from tripbreaker import algorithm
+from tripbreaker.modules.track import PointTrack, TrackPoint
+from tripbreaker.modules.trip_codes import trip_codes
+
+
+### config
+# parameter values to sweep, the combinations are evaluated with the
+# accuracy cutoff varying slowest so that cached stages are reused in turn
+GRID = OrderedDict([
+    ('accuracy_cutoff_meters', [20, 30, 50]),
+    ('break_interval_seconds', [180, 360, 600]),
+    ('subway_buffer_meters', [150, 300, 450])
+])
+# the parameters each stage's output depends on
+STAGE_PARAMETERS = OrderedDict([
+    ('project', ()),
+    ('filter', ('accuracy_cutoff_meters',)),
+    ('segment', ('accuracy_cutoff_meters', 'break_interval_seconds')),
+    ('trips', ('accuracy_cutoff_meters', 'break_interval_seconds', 'subway_buffer_meters'))
+])
+survey = None
+metro_stations = None
+station_indexes = {}
+
+
+class StageCache(object):
+    '''Keeps the last output of each stage with the parameter values it was computed
+       for, counting how many times each stage was computed and reused'''
+    def __init__(self):
+        self.outputs = {}
+        self.computed = Counter()
+        self.reused = Counter()
+
+    def get(self, stage, parameters, compute):
+        key = tuple(parameters[name] for name in STAGE_PARAMETERS[stage])
+        cached = self.outputs.get(stage)
+        if cached is not None and cached[0] == key:
+            self.reused[stage] += 1
+            return cached[1]
+        self.computed[stage] += 1
+        output = compute()
+        self.outputs[stage] = (key, output)
+        return output
+
+
+# the grid's combinations as parameter dictionaries, in the order of `GRID`
+def grid_combinations(grid):
+    names = list(grid)
+    return [OrderedDict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def combination_key(parameters):
+    return tuple(parameters[name] for name in GRID)
+
+
+# copy points so that later stages can label them without changing a cached
+# stage's output, a point listed twice is copied once and listed twice
+def copy_points(points):
+    if points and isinstance(points[0], TrackPoint):
+        indexes, inverse = np.unique([p.index for p in points], return_inverse=True)
+        copies = list(points[0].track.take(indexes))
+        return [copies[i] for i in inverse.tolist()]
+
+    copies = {}
+    for p in points:
+        if id(p) not in copies:
+            row = dict(p)
+            if 'merge_codes' in row:
+                row['merge_codes'] = list(row['merge_codes'])
+            copies[id(p)] = row
+    return [copies[id(p)] for p in points]
+
+
+def copy_segments(segment_groups):
+    copies = iter(copy_points([p for segment in segment_groups.values() for p in segment]))
+    return {num: list(itertools.islice(copies, len(segment)))
+            for num, segment in segment_groups.items()}
+
+
+# evaluate every combination on one user's points, returning the number of trips
+# and the count of each trip code by combination
+def sweep_user(points, combinations, cache=None):
+    cache = cache if cache is not None else StageCache()
+    zone = algorithm.survey_utm_zone({}, metro_stations)
+    results = {}
+    for parameters in combinations:
+        projected = cache.get('project', parameters, lambda: algorithm.project_points(points, zone=zone))
+        if not projected:
+            results[combination_key(parameters)] = (0, Counter())
+            continue
+        filtered = cache.get('filter', parameters, lambda: list(algorithm.stream_filtered(
+            projected, cutoff=parameters['accuracy_cutoff_meters'], check_speed=60)))
+        segment_groups = cache.get('segment', parameters, lambda: dict(algorithm.stream_timegap_segments(
+            copy_points(filtered), timegap=parameters['break_interval_seconds'])))
+
+        buffer_m = parameters['subway_buffer_meters']
+        if buffer_m not in station_indexes:
+            station_indexes[buffer_m] = algorithm.survey_station_index(metro_stations, zone, buffer_m)
+        trips, summaries = cache.get('trips', parameters, lambda: algorithm.trips_from_segments(
+            parameters, station_indexes[buffer_m], copy_segments(segment_groups)))
+        codes = Counter(s['trip_code'] for s in summaries.values()) if summaries else Counter()
+        results[combination_key(parameters)] = (len(summaries) if summaries else 0, codes)
+    return results
+
+
+### input
+# survey users are read with the survey runner's queries, imported here so that
+# synthetic sweeps do not need the survey database
+def open_survey(parquet_dir=None):
+    global survey
+    import run_tripbreaker_on_survey as survey
+    if parquet_dir:
+        survey.open_parquet_source(parquet_dir)
+
+
+def load_user(mobile_uuid, synthetic_points, columnar):
+    if synthetic_points:
+        seed = int(mobile_uuid.rsplit('-', 1)[1])
+        points = generate_points(synthetic_points, seed=seed, metro_stations=metro_stations,
+                                 uuid=mobile_uuid)
+        return PointTrack.from_rows(points, uuid=mobile_uuid) if columnar else points
+    return survey.fetch_user_coordinates(mobile_uuid, columnar=columnar)
+
+
+# each worker reconnects to the input rather than sharing the parent's connection
+def init_worker(stations, parquet_dir=None, synthetic=False):
+    global metro_stations
+    metro_stations = stations
+    if not synthetic:
+        open_survey(parquet_dir)
+        survey.in_db = survey.dataset.connect(survey.CONFIG['in_db_uri'])
+
+
+# sweep a user within a worker, returning the error instead of raising so that
+# one failed user does not stop the sweep
+def sweep_user_worker(args):
+    mobile_uuid, combinations, synthetic_points, columnar = args
+    cache = StageCache()
+    results, error = None, None
+    t0 = time.perf_counter()
+    try:
+        points = load_user(mobile_uuid, synthetic_points, columnar)
+        results = sweep_user(points, combinations, cache=cache)
+    except Exception:
+        error = traceback.format_exc()
+    return mobile_uuid, results, cache.computed, error, time.perf_counter() - t0
+
+
+### report
+def code_columns(totals):
+    seen = set(itertools.chain.from_iterable(codes for _, codes in totals.values()))
+    return sorted(set(trip_codes.values()) | seen)
+
+
+def report_sweep(totals, num_users, computed):
+    codes = code_columns(totals)
+    header = ''.join('{n:>10}'.format(n=name.split('_')[0]) for name in GRID)
+    header += '{t:>10}{u:>11}'.format(t='trips', u='per user')
+    header += ''.join('{c:>8}'.format(c=c) for c in codes)
+    lines = [header]
+    for key, (num_trips, trip_code_counts) in totals.items():
+        line = ''.join('{v:>10}'.format(v=v) for v in key)
+        line += '{t:>10}{u:>11.2f}'.format(t=num_trips, u=num_trips / num_users if num_users else 0.)
+        line += ''.join('{n:>8}'.format(n=trip_code_counts.get(c, 0)) for c in codes)
+        lines.append(line)
+    lines.append('Stages computed: ' + ', '.join('{s} {n}'.format(s=stage, n=computed[stage])
+                                               for stage in STAGE_PARAMETERS))
+    return '\n'.join(lines)
+
+
+def save_sweep_csv(totals, num_users, csv_fp):
+    codes = code_columns(totals)
+    with open(csv_fp, 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(list(GRID) + ['users', 'trips'] + ['trip_code_{c}'.format(c=c) for c in codes])
+        for key, (num_trips, trip_code_counts) in totals.items():
+            writer.writerow(list(key) + [num_users, num_trips] + [trip_code_counts.get(c, 0) for c in codes])
+    print('Saved sweep results to {fp}'.format(fp=csv_fp))
+
+
+def run(grid=GRID, workers=1, columnar=False, parquet_dir=None, synthetic_users=0,
+        synthetic_points=10000, csv_fp=None):
+    combinations = grid_combinations(grid)
+    if synthetic_users:
+        from synthetic_itinerum import load_metro_stations
+        stations = load_metro_stations()
+        mobile_uuids = ['synthetic-{i}'.format(i=i) for i in range(synthetic_users)]
+    else:
+        open_survey(parquet_dir)
+        stations = survey.load_metro_stations(survey.CONFIG['subway_stations_index'])
+        mobile_uuids = survey.fetch_survey_uuids()
+        # schedule the users with the most points first
+        point_counts = survey.fetch_user_point_counts()
+        mobile_uuids.sort(key=lambda u: point_counts.get(u, 0), reverse=True)
+    print('Sweeping {c} combinations over {n} users...'.format(c=len(combinations), n=len(mobile_uuids)))
+
+    totals = OrderedDict((combination_key(p), [0, Counter()]) for p in combinations)
+    computed, failed_uuids = Counter(), []
+    t0 = time.perf_counter()
+    pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(stations, parquet_dir, bool(synthetic_users)))
+    try:
+        jobs = ((mobile_uuid, combinations, synthetic_points if synthetic_users else 0, columnar)
+                for mobile_uuid in mobile_uuids)
+        for mobile_uuid, results, user_computed, error, seconds in pool.imap_unordered(sweep_user_worker, jobs):
+            if error:
+                print('Failed to sweep {uuid}:\n{error}'.format(uuid=mobile_uuid, error=error))
+                failed_uuids.append(mobile_uuid)
+                continue
+            computed.update(user_computed)
+            for key, (num_trips, codes) in results.items():
+                totals[key][0] += num_trips
+                totals[key][1].update(codes)
+    finally:
+        pool.close()
+        pool.join()
+
+    num_users = len(mobile_uuids) - len(failed_uuids)
+    print(report_sweep(totals, num_users, computed))
+    print('Swept {n} users in {s:.1f} sec with {f} failures.'.format(
+        n=len(mobile_uuids), s=time.perf_counter() - t0, f=len(failed_uuids)))
+    if csv_fp:
+        save_sweep_csv(totals, num_users, csv_fp)
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep the tripbreaker parameters over a survey.')
+    for name, values in GRID.items():
+        parser.add_argument('--{o}'.format(o=name.replace('_', '-')), dest=name, type=int,
+                            nargs='+', default=values,
+                            help='values of {n} to sweep (default: {v})'.format(
+                                n=name, v=' '.join(str(v) for v in values)))
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes to spread users across (default: all cores)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='hold each user\'s points in columnar arrays rather than dictionaries')
+    parser.add_argument('--parquet', metavar='PARQUET_DIR',
+                        help='read users from the Parquet files written by load_csvs_to_parquet.py')
+    parser.add_argument('--synthetic', type=int, default=0, metavar='USERS',
+                        help='sweep this many synthetic users instead of the survey')
+    parser.add_argument('--points', type=int, default=10000,
+                        help='points per synthetic user (default: 10000)')
+    parser.add_argument('--csv', metavar='CSV_FP',
+                        help='save the trips and trip codes of each combination to a .csv file')
+    args = parser.parse_args()
+    grid = OrderedDict((name, sorted(set(getattr(args, name)))) for name in GRID)
+    run(grid=grid, workers=args.workers, columnar=args.columnar, parquet_dir=args.parquet,
+        synthetic_users=args.synthetic, synthetic_points=args.points, csv_fp=args.csv)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# Kyle Fitzsimmons, 2018
+#
+# Seeded generator of synthetic Itinerum coordinates for benchmarking and
+# testing the tripbreaker without survey data. A user travels between a few
+# regular places by walking, driving or metro (vanishing underground between
+# stations from the metro stations .csv), stops recording while dwelling and
+# gets noisy accuracies, GPS jumps and cold starts along the way.
+import argparse
+import csv
+import math
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+
+STATIONS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'data', 'metro_stations.csv')
+METERS_PER_DEGREE = 111320.
+LOCAL_TIMEZONE = timezone(timedelta(hours=-4))
+COORDINATES_COLUMNS = ['id', 'uuid', 'latitude', 'longitude', 'altitude', 'speed',
+                       'v_accuracy', 'h_accuracy', 'timestamp']
+
+# travel speeds in m/s and the recording intervals the app uses while moving
+MODES = {
+    'walk': {'speed': 1.4, 'intervals': (1, 2, 5, 10)},
+    'drive': {'speed': 11., 'intervals': (1, 1, 2, 5)},
+    'metro': {'speed': 9., 'intervals': ()}
+}
+# horizontal accuracy bands in meters and their probabilities
+ACCURACY_BANDS = [
+    ((4., 15.), 0.8),
+    ((15., 50.), 0.15),
+    ((50., 200.), 0.05)
+]
+GPS_JUMP_PROBABILITY = 0.002
+COLD_START_PROBABILITY = 0.2
+
+
+def load_metro_stations(csv_fp=STATIONS_CSV):
+    metro_stations = []
+    with open(csv_fp, 'r', encoding='utf-8-sig') as csv_f:
+        for r in csv.DictReader(csv_f):
+            metro_stations.append({'latitude': float(r['Y']), 'longitude': float(r['X'])})
+    return metro_stations
+
+
+# approximate distance in meters on a local equirectangular plane
+def local_distance(lat1, lon1, lat2, lon2):
+    dx = (lon2 - lon1) * METERS_PER_DEGREE * math.cos(math.radians(lat1))
+    dy = (lat2 - lat1) * METERS_PER_DEGREE
+    return math.hypot(dx, dy)
+
+
+def local_offset(lat, lon, dx, dy):
+    return (lat + dy / METERS_PER_DEGREE,
+            lon + dx / (METERS_PER_DEGREE * math.cos(math.radians(lat))))
+
+
+class SyntheticUser(object):
+    '''Simulates a single user's travel and records their points as the Itinerum app
+       would, with all randomness drawn from one seeded generator'''
+    def __init__(self, seed=0, metro_stations=None, uuid=None, start=None):
+        self.random = random.Random(seed)
+        self.metro_stations = metro_stations if metro_stations is not None else load_metro_stations()
+        self.uuid = uuid or '00000000-0000-4000-8000-{:012d}'.format(seed)
+        self.timestamp = start or datetime(2017, 9, 1, 7, 0, tzinfo=LOCAL_TIMEZONE)
+        self.points = []
+
+        # regular places scattered around the metro network
+        center = self.random.choice(self.metro_stations)
+        self.places = []
+        for _ in range(5):
+            self.places.append(local_offset(center['latitude'], center['longitude'],
+                                            self.random.uniform(-6000., 6000.),
+                                            self.random.uniform(-6000., 6000.)))
+        self.place = 0
+        self.latitude, self.longitude = self.places[self.place]
+        self.altitude = self.random.uniform(20., 60.)
+
+    def accuracy(self):
+        draw = self.random.random()
+        for (low, high), probability in ACCURACY_BANDS:
+            if draw < probability:
+                return self.random.uniform(low, high)
+            draw -= probability
+        return ACCURACY_BANDS[-1][0][1]
+
+    # record a point at the current position with noise scaled to its accuracy
+    def record(self, speed):
+        h_accuracy = self.accuracy()
+        noise = h_accuracy / 2.
+        if self.random.random() < GPS_JUMP_PROBABILITY:
+            noise = self.random.uniform(500., 2000.)
+        latitude, longitude = local_offset(self.latitude, self.longitude,
+                                           self.random.gauss(0., noise),
+                                           self.random.gauss(0., noise))
+        self.points.append({
+            'id': len(self.points) + 1,
+            'uuid': self.uuid,
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': self.altitude + self.random.gauss(0., 3.),
+            'speed': max(0., speed + self.random.gauss(0., speed * 0.2)),
+            'v_accuracy': self.random.uniform(3., 12.),
+            'h_accuracy': h_accuracy,
+            'timestamp': self.timestamp
+        })
+
+    # move in a straight line with some wandering, recording points unless hidden
+    def travel_to(self, latitude, longitude, mode, record=True):
+        settings = MODES[mode]
+        while True:
+            remaining = local_distance(self.latitude, self.longitude, latitude, longitude)
+            interval = self.random.choice(settings['intervals']) if settings['intervals'] else 60
+            step = settings['speed'] * interval * self.random.uniform(0.6, 1.3)
+            if remaining <= step:
+                self.latitude, self.longitude = latitude, longitude
+                self.timestamp += timedelta(seconds=int(math.ceil(remaining / settings['speed'])))
+                if record:
+                    self.record(settings['speed'])
+                return
+            ratio = step / remaining
+            heading = self.random.gauss(0., 0.15)
+            dx = (longitude - self.longitude) * ratio
+            dy = (latitude - self.latitude) * ratio
+            self.latitude += dy * math.cos(heading) - dx * math.sin(heading)
+            self.longitude += dx * math.cos(heading) + dy * math.sin(heading)
+            self.timestamp += timedelta(seconds=interval)
+            # drivers stop briefly at lights without pausing the recording
+            if mode == 'drive' and self.random.random() < 0.01:
+                self.timestamp += timedelta(seconds=self.random.randint(20, 90))
+            if record:
+                self.record(settings['speed'])
+
+    def nearest_station(self, latitude, longitude):
+        return min(self.metro_stations,
+                   key=lambda s: local_distance(latitude, longitude, s['latitude'], s['longitude']))
+
+    # walk to a station, disappear underground and resurface at the station nearest
+    # the destination before walking the rest of the way
+    def metro_trip(self, latitude, longitude):
+        origin = self.nearest_station(self.latitude, self.longitude)
+        destination = self.nearest_station(latitude, longitude)
+        self.travel_to(origin['latitude'], origin['longitude'], 'walk')
+        self.timestamp += timedelta(seconds=self.random.randint(60, 480))
+        self.travel_to(destination['latitude'], destination['longitude'], 'metro', record=False)
+        self.travel_to(latitude, longitude, 'walk')
+
+    # the app stops recording while stationary so a dwell leaves a gap in time
+    def dwell(self):
+        self.timestamp += timedelta(seconds=self.random.randint(10 * 60, 9 * 60 * 60))
+
+    def trip(self):
+        self.place = self.random.choice([p for p in range(len(self.places)) if p != self.place])
+        latitude, longitude = self.places[self.place]
+        latitude, longitude = local_offset(latitude, longitude,
+                                           self.random.gauss(0., 30.), self.random.gauss(0., 30.))
+        distance = local_distance(self.latitude, self.longitude, latitude, longitude)
+        if distance < 1200.:
+            mode = 'walk'
+        else:
+            mode = self.random.choice(['drive', 'drive', 'metro'])
+
+        # a cold start misses the beginning of a trip until the first fix
+        if self.random.random() < COLD_START_PROBABILITY:
+            skipped = self.random.uniform(0.1, 0.4)
+            self.travel_to(self.latitude + (latitude - self.latitude) * skipped,
+                           self.longitude + (longitude - self.longitude) * skipped,
+                           'walk' if mode == 'walk' else 'drive', record=False)
+
+        if mode == 'metro':
+            self.metro_trip(latitude, longitude)
+        else:
+            self.travel_to(latitude, longitude, mode)
+
+    def generate(self, num_points):
+        while len(self.points) < num_points:
+            self.trip()
+            self.dwell()
+        return self.points[:num_points]
+
+
+def generate_points(num_points, seed=0, metro_stations=None, uuid=None):
+    '''Return a list of Itinerum coordinate rows with Python-typed values as produced
+       by the runners' `serialize_row_types`'''
+    return SyntheticUser(seed=seed, metro_stations=metro_stations, uuid=uuid).generate(num_points)
+
+
+# write users' points in the layout of an Itinerum coordinates .csv export
+def write_coordinates_csv(csv_fp, num_points, num_users=1, seed=0):
+    metro_stations = load_metro_stations()
+    with open(csv_fp, 'w', newline='') as csv_f:
+        writer = csv.DictWriter(csv_f, fieldnames=COORDINATES_COLUMNS)
+        writer.writeheader()
+        row_id = 0
+        for user_num in range(num_users):
+            for point in generate_points(num_points, seed=seed + user_num,
+                                         metro_stations=metro_stations):
+                row_id += 1
+                row = dict(point)
+                row['id'] = row_id
+                row['timestamp'] = point['timestamp'].isoformat()
+                writer.writerow(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic Itinerum coordinates.')
+    parser.add_argument('output', help='path of the coordinates .csv to write')
+    parser.add_argument('--points', type=int, default=10000, help='points per user')
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_coordinates_csv(args.output, args.points, num_users=args.users, seed=args.seed)
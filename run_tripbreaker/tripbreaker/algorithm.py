@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 # Kyle Fitzsimmons, 2015
 import itertools
-import utm
-from tripbreaker.modules import labels, tools
+import numpy as np
+from tripbreaker.modules import distance, instrumentation, labels, tools
+from tripbreaker.modules.station_index import StationIndex
+from tripbreaker.modules.track import PointTrack, RowColumns
 from tripbreaker.modules.trip_codes import trip_codes
 
 
+@instrumentation.stage()
 def filter_accuracy(points, cutoff=30):
     '''Filter out points with high reported horizontal accuracy values'''
+    if isinstance(points, PointTrack):
+        for p in points.points(np.flatnonzero(points.h_accuracy <= cutoff)):
+            yield p
+        return
+
     for p in points:
         if p['h_accuracy'] <= cutoff:
             yield p
 
 
+@instrumentation.stage()
 def filter_errorneous_distance(points, check_speed=60):
     '''Filter out points with unreasonably fast speeds where next point is closer
        than erroneous point'''
@@ -21,7 +30,9 @@ def filter_errorneous_distance(points, check_speed=60):
 
     last_p = None
     for p in points:
-        next_p = next(points_copy)
+        next_p = next(points_copy, None)
+        if next_p is None:
+            return
 
         # do not test first point but save for testing next point
         if not last_p:
@@ -47,6 +58,7 @@ def filter_errorneous_distance(points, check_speed=60):
         yield p
 
 
+@instrumentation.stage()
 def break_by_timegap(points, timegap=360):
     '''Break into trip segments when time recorded between points is
        > timegap variable and group points by segment number in a dictionary'''
@@ -67,7 +79,7 @@ def break_by_timegap(points, timegap=360):
         row['break_period'] = period
         row['note'] = ''
         row['merge_codes'] = []
-        trips.append(dict(row))
+        trips.append(row)
 
     # group trips by segments in a lookup dictionary
     segment_groups = {}
@@ -77,24 +89,401 @@ def break_by_timegap(points, timegap=360):
     return segment_groups
 
 
-def metro_stations_utm(metro_stations):
-    '''Get UTM coordinates for metro stations supplied by database lat/lngs'''
-    stations = []
-    for station in metro_stations:
-        northing, easting, _, _ = utm.from_latlon(station['latitude'], station['longitude'])
-        stations.append((northing, easting))
-    return stations
+def stream_filtered(points, cutoff=30, check_speed=60):
+    '''Filter points by accuracy and erroneous speed in a single pass, looking one point
+       ahead; yields the points kept by `filter_accuracy` and `filter_errorneous_distance`
+       run in sequence, including the first point twice. While instrumented, the points
+       each filter keeps are recorded under its name once the points are consumed, with
+       no time of their own as it is charged to the stage consuming them.'''
+    if isinstance(points, PointTrack):
+        kept = filter_track(points, cutoff=cutoff, check_speed=check_speed)
+        for i, p in enumerate(points.points(kept)):
+            if i == 0:
+                yield p
+            yield p
+        return
+
+    registry = instrumentation.current()
+    if registry is not None and not isinstance(points, list):
+        points = list(points)
+    num_points = len(points) if registry is not None else None
+    points = (p for p in points if p['h_accuracy'] <= cutoff)
+
+    # the first point is counted once although it is yielded twice, and the last
+    # point, which cannot be tested, is dropped as by `filter_errorneous_distance`
+    num_accurate, num_kept = 0, 0
+    last_p = None
+    p = next(points, None)
+    if p is not None:
+        num_accurate = 1
+    for next_p in points:
+        num_accurate += 1
+        # the first point is kept twice as `filter_errorneous_distance` yields it twice
+        if last_p is None:
+            last_p = p
+            num_kept += 1
+            yield p
+            yield p
+            p = next_p
+            continue
+
+        distance_from_last_point = tools.pythagoras((last_p['easting'], last_p['northing']),
+                                                    (p['easting'], p['northing']))
+        seconds_since_last_point = (p['timestamp'] - last_p['timestamp']).total_seconds()
+        accepted = True
+        if distance_from_last_point and seconds_since_last_point:
+            kph_since_last_point = (distance_from_last_point / seconds_since_last_point) * 3.6
+            distance_between_adjacent_points = tools.pythagoras((last_p['easting'], last_p['northing']),
+                                                                (next_p['easting'], next_p['northing']))
+            if (kph_since_last_point >= check_speed and
+                distance_between_adjacent_points < distance_from_last_point):
+                accepted = False
+        if accepted:
+            last_p = p
+            num_kept += 1
+            yield p
+        p = next_p
+
+    record_filter_counts(num_points, num_accurate, num_kept)
+
+
+def record_filter_counts(num_points, num_accurate, num_kept):
+    '''Record the points kept by each filter of a fused pass while instrumented'''
+    registry = instrumentation.current()
+    if registry is not None:
+        registry.record('filter_accuracy', wall=0., cpu=0., points_in=num_points,
+                        points_out=num_accurate)
+        registry.record('filter_errorneous_distance', wall=0., cpu=0., points_in=num_accurate,
+                        points_out=num_kept)
+
+
+def filter_track(track, cutoff=30, check_speed=60):
+    '''Return the row indexes of a PointTrack kept by `stream_filtered`, the first once,
+       testing speeds on the track's arrays. A point is tested against the last point
+       accepted, which is the point before it unless that one was rejected, so the tests
+       against the point before are made for every point at once and only the points
+       after a rejection are tested one by one.'''
+    accurate = np.flatnonzero(track.h_accuracy <= cutoff)
+    num_accurate = len(accurate)
+    keep = np.ones(num_accurate, dtype=bool)
+    if num_accurate < 2:
+        keep[:] = False
+        record_filter_counts(len(track), num_accurate, 0)
+        return accurate[keep]
+    # the last point has no next point to be tested with and is never kept
+    keep[-1] = False
+
+    eastings, northings = track.easting[accurate], track.northing[accurate]
+    seconds = track.timestamp[accurate]
+    legs = tools.pythagoras_arrays(eastings[:-1], northings[:-1], eastings[1:], northings[1:])
+    skips = tools.pythagoras_arrays(eastings[:-2], northings[:-2], eastings[2:], northings[2:])
+    periods = np.diff(seconds).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fast = (legs != 0) & (periods != 0) & (legs / periods * 3.6 >= check_speed)
+    # rejected[i] tests point i + 1 against point i and the point after it
+    rejected = (fast[:-1] & (skips < legs[:-1])).tolist()
+
+    def rejects(last, q):
+        distance_from_last_point = tools.pythagoras((float(eastings[last]), float(northings[last])),
+                                                    (float(eastings[q]), float(northings[q])))
+        seconds_since_last_point = float(seconds[q] - seconds[last])
+        if not (distance_from_last_point and seconds_since_last_point):
+            return False
+        kph_since_last_point = (distance_from_last_point / seconds_since_last_point) * 3.6
+        distance_between_adjacent_points = tools.pythagoras(
+            (float(eastings[last]), float(northings[last])),
+            (float(eastings[q + 1]), float(northings[q + 1])))
+        return (kph_since_last_point >= check_speed and
+                distance_between_adjacent_points < distance_from_last_point)
+
+    q = 1
+    for r in np.flatnonzero(rejected).tolist():
+        if r + 1 < q:
+            continue
+        # the points before were accepted, each following an accepted point
+        q = r + 1
+        last = r
+        keep[q] = False
+        q += 1
+        while q < num_accurate - 1:
+            keep[q] = not rejects(last, q)
+            q += 1
+            if keep[q - 1]:
+                break
+
+    kept = accurate[keep]
+    record_filter_counts(len(track), num_accurate, len(kept))
+    return kept
+
+
+def stream_timegap_segments(points, timegap=360):
+    '''Break filtered points into segments by timegap, yielding each (segment number, points)
+       as soon as the gap after it is seen; the result matches `break_by_timegap`'''
+    segment, group = [], 1
+    previous_row = None
+    for row in points:
+        if previous_row is None:
+            period = 0
+        else:
+            period = int((row['timestamp'] - previous_row['timestamp']).total_seconds())
+            if period > timegap:
+                yield group, segment
+                segment = []
+                group += 1
+        previous_row = row
+
+        row['segment_group'] = group
+        row['break_period'] = period
+        row['note'] = ''
+        row['merge_codes'] = []
+        segment.append(row)
+
+    if segment:
+        yield group, segment
+
+
+def stream_segments(points, cutoff=30, check_speed=60, timegap=360):
+    '''Filter points by accuracy and erroneous speed and break them into segments by timegap
+       in a single pass over the points, see `stream_filtered` and `stream_timegap_segments`;
+       a PointTrack is filtered and broken on its arrays by `track_segments`'''
+    if isinstance(points, PointTrack):
+        return track_segments(points, cutoff=cutoff, check_speed=check_speed, timegap=timegap)
+    filtered = stream_filtered(points, cutoff=cutoff, check_speed=check_speed)
+    return stream_timegap_segments(filtered, timegap=timegap)
+
+
+def track_segments(track, cutoff=30, check_speed=60, timegap=360):
+    '''Filter and break a PointTrack into segments on its arrays, writing the columns
+       `stream_timegap_segments` sets for the kept rows at once and yielding each (segment
+       number, points) with the points as views, the first point twice'''
+    kept = filter_track(track, cutoff=cutoff, check_speed=check_speed)
+    if not len(kept):
+        return
+    rows = np.concatenate((kept[:1], kept))
+    periods = np.concatenate(([0], np.diff(track.timestamp[rows])))
+    groups = 1 + np.cumsum(periods > timegap)
+
+    columns = {
+        'segment_group': groups,
+        'break_period': periods,
+        'note': track.note_code(''),
+        'merge_codes': 0
+    }
+    for key, values in columns.items():
+        track.columns[key][rows] = values
+        mask = track.present.get(key)
+        if mask is not None:
+            mask[rows] = True
+
+    views = list(track.points(kept))
+    views.insert(0, views[0])
+    ends = np.flatnonzero(np.diff(groups)) + 1
+    starts = np.concatenate(([0], ends)).tolist()
+    ends = np.concatenate((ends, [len(rows)])).tolist()
+    for start, end in zip(starts, ends):
+        yield int(groups[start]), views[start:end]
+
+
+@instrumentation.stage()
+def break_into_segments(points, cutoff=30, check_speed=60, timegap=360):
+    '''Group the segments streamed by `stream_segments` by segment number in a dictionary'''
+    return dict(stream_segments(points, cutoff=cutoff, check_speed=check_speed, timegap=timegap))
+
+
+DECIMATE_DEFAULTS = {
+    'stationary_radius': 10.,
+    'stationary_interval': 120,
+    'min_distance': 20.,
+    'moving_interval': 30
+}
+
+
+def decimation_settings(parameters):
+    '''Settings for `decimate` from the `decimate` parameter, True for the defaults or a
+       dictionary overriding some of them; intervals are capped at the break interval'''
+    settings = dict(DECIMATE_DEFAULTS)
+    if isinstance(parameters['decimate'], dict):
+        settings.update(parameters['decimate'])
+    timegap = parameters['break_interval_seconds']
+    settings['stationary_interval'] = min(settings['stationary_interval'], timegap)
+    settings['moving_interval'] = min(settings['moving_interval'], timegap)
+    settings['cutoff'] = parameters['accuracy_cutoff_meters']
+    settings['timegap'] = timegap
+    return settings
+
+
+@instrumentation.stage()
+def decimate(points, cutoff=30, check_speed=60, timegap=360, stationary_radius=10.,
+             stationary_interval=120, min_distance=20., moving_interval=30):
+    '''Thin the redundant points of high-frequency recordings before `filter_accuracy`:
+       exact duplicates of the last kept point, points of a stationary cluster within
+       `stationary_radius` meters of it for up to `stationary_interval` seconds and, while
+       moving, points within `min_distance` meters of it for up to `moving_interval` seconds.
+       Only points passing the accuracy cutoff are thinned and a point is dropped only when
+       the points kept around it are within the interval, so no gap longer than `timegap`
+       appears, and when the filter of erroneous speeds is replayed to keep every point it
+       would accept or reject with its neighbours, so segments keep the same endpoints.
+       Path distances are measured between the kept points only, so thinning the
+       jitter of a track shortens `trip_distance` and `cumulative_distance` and can change
+       a trip's code at the 250 meter threshold in `summarize`.'''
+    if isinstance(points, PointTrack):
+        accurate = np.flatnonzero(points.h_accuracy <= cutoff)
+        seconds = points.timestamp[accurate].tolist()
+        eastings = points.easting[accurate].tolist()
+        northings = points.northing[accurate].tolist()
+    else:
+        points = list(points)
+        accurate = [i for i, p in enumerate(points) if p['h_accuracy'] <= cutoff]
+        first = points[accurate[0]]['timestamp'] if accurate else None
+        seconds = [(points[i]['timestamp'] - first).total_seconds() for i in accurate]
+        eastings = [points[i]['easting'] for i in accurate]
+        northings = [points[i]['northing'] for i in accurate]
+
+    # the legs between consecutive points are measured at once, other legs as needed
+    leg_distances = tools.pythagoras_arrays(np.asarray(eastings[:-1]), np.asarray(northings[:-1]),
+                                            np.asarray(eastings[1:]), np.asarray(northings[1:]))
+    leg_periods = np.diff(np.asarray(seconds, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slow_legs = ((leg_distances == 0) |
+                     ((leg_periods > 0) & (leg_distances / leg_periods * 3.6 < check_speed))).tolist()
+    leg_distances, leg_periods = leg_distances.tolist(), leg_periods.tolist()
+
+    def leg(i, j):
+        if j == i + 1:
+            return leg_distances[i], leg_periods[i]
+        return (tools.pythagoras((eastings[i], northings[i]), (eastings[j], northings[j])),
+                seconds[j] - seconds[i])
+
+    # legs slower than `check_speed` never reject a point, and a point dropped between two
+    # slow legs leaves a slow leg between its neighbours
+    def slow(distance, period):
+        return not distance or (period > 0 and distance / period * 3.6 < check_speed)
+
+    # `a` is the last point kept and `accepted` the last point accepted by the replayed
+    # filter, `a` is accepted whichever point follows it when reached by a slow leg. The
+    # last two points are kept since the filter never yields the last point of a user.
+    keep = np.ones(len(accurate), dtype=bool)
+    a, accepted, anchored = 0, None, True
+    for q in range(1, len(accurate) - 2):
+        b = q + 1
+        span = seconds[b] - seconds[a]
+        if anchored and slow_legs[q] and span <= timegap:
+            distance_aq, period_aq = leg(a, q)
+            if slow(distance_aq, period_aq):
+                duplicate = not distance_aq and not period_aq
+                stationary = (span <= stationary_interval and distance_aq <= stationary_radius and
+                              leg(a, b)[0] <= stationary_radius)
+                moving = span <= moving_interval and distance_aq < min_distance
+                if duplicate or stationary or moving:
+                    keep[q] = False
+                    continue
+
+        # replay `stream_filtered` for the kept point with the next one kept after it
+        if accepted is None:
+            accepted = a
+        else:
+            distance, period = leg(accepted, a)
+            if not (distance and period and distance / period * 3.6 >= check_speed and
+                    leg(accepted, q)[0] < distance):
+                accepted = a
+        a = q
+        anchored = slow(*leg(accepted, a))
+
+    if keep.all():
+        return points
+    drop = np.asarray(accurate)[~keep]
+    if isinstance(points, PointTrack):
+        mask = np.ones(len(points), dtype=bool)
+        mask[drop] = False
+        return points.take(mask)
+    dropped = set(drop.tolist())
+    return [p for i, p in enumerate(points) if i not in dropped]
+
+
+def metro_stations_utm(metro_stations, zone=None, projection=None):
+    '''Get UTM coordinates for metro stations supplied by database lat/lngs, or coordinates
+       in the plane of a distance backend's `project` when one is given'''
+    latitudes = [float(station['latitude']) for station in metro_stations]
+    longitudes = [float(station['longitude']) for station in metro_stations]
+    if projection is None:
+        eastings, northings, valid, _ = tools.project_utm(latitudes, longitudes, zone=zone)
+    else:
+        eastings, northings, valid = projection(latitudes, longitudes)
+    return list(zip(eastings[valid].tolist(), northings[valid].tolist()))
+
+
+def survey_utm_zone(parameters, metro_stations):
+    '''Determine the UTM zone shared by the stations and a user's points; an explicit
+       `utm_zone` parameter wins, otherwise the survey's metro network fixes the zone'''
+    if parameters.get('utm_zone'):
+        return tuple(parameters['utm_zone'])
+    if isinstance(metro_stations, StationIndex):
+        return metro_stations.zone
+    if metro_stations:
+        return tools.select_utm_zone([float(s['latitude']) for s in metro_stations],
+                                     [float(s['longitude']) for s in metro_stations])
+    return None
+
+
+def survey_station_index(metro_stations, zone, cell_size, projection=None):
+    '''Index the metro stations in the zone of a run; a compiled index is already projected
+       and is used as it is, with a lookup cache of its own for the run, unless the stations
+       are projected to another plane'''
+    if projection is not None:
+        if isinstance(metro_stations, StationIndex):
+            metro_stations = metro_stations.records
+        return StationIndex(metro_stations_utm(metro_stations, projection=projection),
+                            cell_size=cell_size)
+    if isinstance(metro_stations, StationIndex):
+        if metro_stations.zone != zone:
+            raise ValueError('Station index is projected in UTM zone {i}, not {z}'.format(
+                i=metro_stations.zone, z=zone))
+        return metro_stations.view()
+    return StationIndex(metro_stations_utm(metro_stations, zone=zone), cell_size=cell_size)
+
+
+def project_points(points, zone=None, projection=None):
+    if isinstance(points, PointTrack):
+        return points.project_utm(zone=zone, projection=projection)
+    return tools.process_utm(points, zone=zone, projection=projection)
+
+
+def project_survey(parameters, metro_stations, points):
+    '''Project the metro stations and a user's points onto the plane distances are measured
+       in, chosen by the `distance_backend` parameter: the survey's UTM zone by default, or
+       with `local` a plane anchored on the user's points that skips UTM projection within
+       the error bound of `distance.LocalPlaneBackend`'''
+    backend = parameters.get('distance_backend', 'utm')
+    if backend not in distance.BACKENDS or not distance.BACKENDS[backend].planar:
+        raise ValueError('The tripbreaker measures distances between projected points, '
+                         'distance_backend must be utm or local, not {b}'.format(b=backend))
+    if backend == 'local':
+        # the plane is anchored on the user's points, so they are projected first
+        projection = distance.LocalPlaneBackend(anchor=parameters.get('plane_anchor')).project
+        points = project_points(points, projection=projection)
+        stations = survey_station_index(metro_stations, None, parameters['subway_buffer_meters'],
+                                        projection=projection)
+        return stations, points
+
+    # project stations and points into the same zone so that distances between them hold;
+    # without stations or an explicit zone the user's own points pick the zone
+    zone = survey_utm_zone(parameters, metro_stations)
+    stations = survey_station_index(metro_stations, zone, parameters['subway_buffer_meters'])
+    return stations, project_points(points, zone=zone)
 
 
 def metro_buffer(stations, point, distance):
     '''Return a boolean indicating whether a point is within a specified distance of
        of a dictionary of metro stations'''
+    if isinstance(stations, StationIndex):
+        return stations.buffer(point, distance)
     for station in stations:
         if tools.pythagoras(station, point) <= distance:
             return True, station
     return False, None
 
 
+@instrumentation.stage(points_arg=1)
 def find_metro_transfers(stations, segment_groups, buffer_m):
     '''Create a list of tuples containing two consecutive segment numbers. Test the last (end) point
         of the first segment and the first (start) point of the second segment to identify a transfer'''
@@ -156,6 +545,7 @@ def find_metro_transfers(stations, segment_groups, buffer_m):
     return linked_trips
 
 
+@instrumentation.stage()
 def connect_by_velocity(linked_trips):
     velocity_connections = {}
     last_trip = None
@@ -178,11 +568,16 @@ def connect_by_velocity(linked_trips):
     return velocity_connections
 
 
+@instrumentation.stage()
 def filter_single_points(linked_trips):
     '''Detects single points and attaches to nearest to/from trip within 20 minute
        time period and 150 meter radius'''
 
-    test_trips = tools.quick_deepcopy(linked_trips)
+    # attach single points by reference into new trip lists so `linked_trips` keeps
+    # its original order for neighbour lookups; a point moved in time is still
+    # measured by the timestamp it was recorded at
+    test_trips = {num: list(trip) for num, trip in linked_trips.items()}
+    recorded_timestamps = {}
     cleaned_trips = {}
     offset = 0
     max_time = 20
@@ -199,6 +594,7 @@ def filter_single_points(linked_trips):
 
             last_trip_num = num - 1
             last_trip_end = linked_trips[last_trip_num][-1]
+            last_trip_end_dt = recorded_timestamps.get(id(last_trip_end), last_trip_end['timestamp'])
             last_trip_pt = (last_trip_end['easting'], last_trip_end['northing'])
             last_trip_dist = tools.pythagoras(last_trip_pt, point_loc)
 
@@ -207,8 +603,9 @@ def filter_single_points(linked_trips):
             next_trip_pt = (next_trip_start['easting'], next_trip_start['northing'])
             next_trip_dist = tools.pythagoras(point_loc, next_trip_pt)
 
+            recorded_timestamps[id(point)] = point_dt
             if last_trip_dist <= next_trip_dist:
-                point['timestamp'] = last_trip_end['timestamp']
+                point['timestamp'] = last_trip_end_dt
                 labels.single_point(point, cleaned_trips[num - offset - 1], 'append')
                 cleaned_trips[num - offset - 1].append(point)
             else:
@@ -221,6 +618,7 @@ def filter_single_points(linked_trips):
     return cleaned_trips
 
 
+@instrumentation.stage(points_arg=1)
 def infer_missing_trips(stations, linked_trips):
     '''Determines the missing distance and period between each trip; key is correlated to linked_trips
        where the missing trip key indicates the gap before the linked trip with the same key'''
@@ -281,6 +679,7 @@ def infer_missing_trips(stations, linked_trips):
     return missing_trips
 
 
+@instrumentation.stage()
 def merge_trips(trips, missing_trips, stations):
     '''Merge and label trips'''
     rows = []
@@ -348,44 +747,53 @@ def merge_trips(trips, missing_trips, stations):
         if len(trip) == 1:
             note = 'single point'
 
+        # label the trip's points in place rather than copying each one
         for point in trip:
-            p = point.copy()
-            p['trip'] = idx + offset
+            point['trip'] = idx + offset
             if note:
-                p['note'] = note
-            rows.append(p)
+                point['note'] = note
+            rows.append(point)
     return rows
 
 
-def distance_speed(trip_group):
-    trip_distance = 0.
-    last_point = None
-
-    # test for the specific case of a single point being attached to a
-    # missing trip <250 m
-    if len(trip_group) == 2:
-        notes = [p['note'] for p in trip_group]
-        if 'missing trip - less than 250m' in notes and 'single point' in notes:
-            for p in trip_group:
-                p['distance'], p['trip_distance'], p['avg_speed'] = 0, 0, 0
-            return trip_group
-
-    for idx, p in enumerate(trip_group):
-        point = (p['easting'], p['northing'])
-        if idx == 0:
-            p['distance'], p['trip_distance'], p['avg_speed'] = 0, 0, 0
-            last_point = point
-        elif last_point:
-            p['distance'] = tools.pythagoras(last_point, point)
-            trip_distance += p['distance']
-            p['trip_distance'] = trip_distance
-            if p['break_period'] > 0:
-                p['avg_speed'] = p['distance'] / p['break_period']
-            else:
-                p['avg_speed'] = trip_group[idx-1]['avg_speed']
-        if p['note'] != 'missing trip - less than 250m':
-            last_point = point
-    return trip_group
+def distance_speed(eastings, northings, break_periods, notes, starts, ends):
+    '''Find the distance from the previous point, the trip's cumulative distance and the
+       average speed since the previous point for all trips' points, given as columns with
+       trips at consecutive [start, end) index ranges. Missing trips under 250m are not used
+       as the previous point and points without a break period carry the last speed forward.'''
+    num_points = len(eastings)
+    indexes = np.arange(num_points)
+    is_start = np.zeros(num_points, dtype=bool)
+    is_start[starts] = True
+
+    # distance from the last point that was not a missing trip under 250m
+    is_anchor = is_start | (np.array(notes, dtype=object) != 'missing trip - less than 250m')
+    anchors = np.maximum.accumulate(np.where(is_anchor, indexes, 0))
+    previous = np.concatenate(([0], anchors[:-1]))
+    distances = tools.pythagoras_arrays(eastings[previous], northings[previous], eastings, northings)
+    distances[is_start] = 0.
+    trip_distances = np.empty(num_points)
+    for start, end in zip(starts, ends):
+        trip_distances[start:end] = np.cumsum(distances[start:end])
+
+    # speed over each point's break period, otherwise the last speed in the trip
+    has_period = ~is_start & (break_periods > 0)
+    speeds = np.zeros(num_points)
+    speeds[has_period] = distances[has_period] / break_periods[has_period]
+    speed_sources = np.maximum.accumulate(np.where(is_start | has_period, indexes, 0))
+
+    distances, trip_distances, speeds = distances.tolist(), trip_distances.tolist(), speeds.tolist()
+    for idx in starts:
+        distances[idx], trip_distances[idx], speeds[idx] = 0, 0, 0
+    speeds = [speeds[source] for source in speed_sources.tolist()]
+
+    # a single point attached to a missing trip <250 m has neither distance nor speed
+    for start, end in zip(starts, ends):
+        if end - start == 2:
+            trip_notes = notes[start:end]
+            if 'missing trip - less than 250m' in trip_notes and 'single point' in trip_notes:
+                distances[start:end] = trip_distances[start:end] = speeds[start:end] = [0, 0]
+    return distances, trip_distances, speeds
 
 
 def labeling_hierarchy(labels):
@@ -403,43 +811,58 @@ def labeling_hierarchy(labels):
     return labels
 
 
+@instrumentation.stage()
 def summarize(rows):
     '''Condense trip to information from first and last GPS point and add attribute information'''
-    # group points into dictionaries by trip id
-    trips, group, last_trip_id = {}, [], 1
-    for row in rows:
-        trip_id = row['trip']
-        if trip_id == last_trip_id:
-            group.append(row)
-        else:
-            if group:
-                trips[last_trip_id] = distance_speed(group)
-                group = [row]
-            last_trip_id = trip_id
-
-    summaries = {}
-    for num, trip in trips.items():
-        labels = list(set([p['note'] for p in trip]))
-        labels = labeling_hierarchy(labels)
+    # group points into dictionaries by runs of trip id; rows before the first trip id
+    # repeated from its previous row (counting from trip 1) and the final trip are not kept
+    columns = RowColumns(rows)
+    ids = columns.column('trip', dtype=np.int64)
+    trip_ids = ids.tolist()
+    repeated = np.flatnonzero(ids == np.concatenate(([1], ids[:-1])))
+    if not len(repeated):
+        return {}, {}
+    first = repeated[0]
+    changes = np.flatnonzero(ids[first + 1:] != ids[first:-1]) + first + 1
+    trips = {}
+    for start, end in zip(np.concatenate(([first], changes[:-1])).tolist(), changes.tolist()):
+        trips[trip_ids[start]] = rows[start:end]
+    if not trips:
+        return trips, {}
+
+    # find distances and speeds for all trips at once over their concatenated points
+    if len(trips) == len(changes):
+        columns = columns.select(first, changes[-1])
+    else:
+        columns = RowColumns([p for trip in trips.values() for p in trip])
+    points = columns.rows
+    notes = columns.notes()
+    merge_codes = columns.merge_codes()
+    ends = np.cumsum([len(trip) for trip in trips.values()])
+    starts = np.concatenate(([0], ends[:-1]))
+    eastings = columns.column('easting')
+    northings = columns.column('northing')
+    break_periods = columns.column('break_period')
+    distances, trip_distances, speeds = distance_speed(eastings, northings, break_periods,
+                                                       notes, starts, ends)
+    direct_distances = tools.pythagoras_arrays(eastings[starts], northings[starts],
+                                               eastings[ends - 1], northings[ends - 1]).tolist()
+
+    summaries, codes = {}, []
+    for num, start, end, direct_distance in zip(trips, starts.tolist(), ends.tolist(), direct_distances):
+        labels = labeling_hierarchy(list(set(notes[start:end])))
         assert len(labels) == 1
         c = trip_codes[labels[0]]
 
-        start_pt = trip[0]
-        end_pt = trip[-1]
-
-        merge_codes = set()
-        for segment in trip:
-            for mcode in segment['merge_codes']:
-                merge_codes.add(mcode)
-
-        direct_distance = tools.pythagoras((start_pt['easting'], start_pt['northing']),
-                                           (end_pt['easting'], end_pt['northing']))
+        start_pt = points[start]
+        end_pt = points[end - 1]
+        trip_distance = trip_distances[end - 1]
 
-        if end_pt['trip_distance'] > 250 and c == 103:
+        if trip_distance > 250 and c == 103:
             c = 1
-        elif end_pt['trip_distance'] == 0:
+        elif trip_distance == 0:
             c = 201
-        elif end_pt['trip_distance'] < 250:
+        elif trip_distance < 250:
             c = 202
 
         outrow = {
@@ -452,28 +875,42 @@ def summarize(rows):
             'start': start_pt['timestamp'],
             'end': end_pt['timestamp'],
             'direct_distance': direct_distance,
-            'cumulative_distance': end_pt['trip_distance'],
-            'merge_codes': ', '.join(merge_codes)
+            'cumulative_distance': trip_distance,
+            # merge codes in the order they were first seen along the trip
+            'merge_codes': ', '.join(dict.fromkeys(itertools.chain.from_iterable(merge_codes[start:end])))
         }
 
         summaries[num] = outrow
+        codes.append(c)
 
-        for p in trip:
-            p['trip_code'] = c
+    columns.assign({
+        'distance': distances,
+        'trip_distance': trip_distances,
+        'avg_speed': speeds,
+        'trip_code': np.repeat(codes, ends - starts).tolist()
+    })
 
     return trips, summaries
 
 
-# @tools.timeit
+@instrumentation.stage(points_arg=2)
 def run(parameters, metro_stations, points):
-    stations = metro_stations_utm(metro_stations)
-    points = tools.process_utm(points)
+    stations, points = project_survey(parameters, metro_stations, points)
     if not points:
         return None, None
 
-    high_accuracy_points = filter_accuracy(points, cutoff=parameters['accuracy_cutoff_meters'])
-    cleaned_points = filter_errorneous_distance(high_accuracy_points, check_speed=60)
-    segment_groups = break_by_timegap(cleaned_points, timegap=parameters['break_interval_seconds'])
+    if parameters.get('decimate'):
+        points = decimate(points, **decimation_settings(parameters))
+    segment_groups = break_into_segments(points,
+                                         cutoff=parameters['accuracy_cutoff_meters'],
+                                         check_speed=60,
+                                         timegap=parameters['break_interval_seconds'])
+    return trips_from_segments(parameters, stations, segment_groups)
+
+
+def trips_from_segments(parameters, stations, segment_groups):
+    '''Link, clean and summarize a user's segments into trips; the segments' lists and points
+       are modified in place'''
     metro_linked_trips = find_metro_transfers(stations, segment_groups, buffer_m=parameters['subway_buffer_meters'])
     velocity_connected_trips = connect_by_velocity(metro_linked_trips)
     cleaned_trips = filter_single_points(velocity_connected_trips)
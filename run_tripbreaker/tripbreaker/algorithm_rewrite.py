@@ -1,40 +1,142 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2015-2017
+'''Span-based linking engine producing the same trips as `algorithm.run`. After filtering,
+   a user's points are kept in one ordered list and segments and trips are [number, start,
+   end) spans over it, so metro, velocity and single point merges only move span bounds
+   instead of rebuilding and renumbering dictionaries of point lists.'''
+from collections import namedtuple
 
+from tripbreaker import algorithm
+from tripbreaker.modules import instrumentation, labels, tools
 
-def filter_accuracy(points, cutoff=30):
-    '''Filter out points with high reported horizontal accuracy values'''
-    for p in points:
-        if p['h_accuracy'] <= cutoff:
-            yield p
 
+# a user's ordered points and the [number, start, end) spans grouping them; numbers
+# follow the keys `algorithm` would give each segment or trip, gaps included
+Spans = namedtuple('Spans', ['points', 'spans'])
 
-def break_by_timegap(points, timegap=360):
-    '''Break into trip segments when time recorded between points is
-       > timegap variable and group points by segment number in a dictionary'''
-    timebreak_groups = [[]]
-    last_point = None
-    for p in points:
-    	if not last_point:
-    		point = last_point
 
+@instrumentation.stage()
+def break_into_segments(points, cutoff=30, check_speed=60, timegap=360):
+    '''Collect the segments streamed by `algorithm.stream_segments` as spans over one list'''
+    rows, spans = [], []
+    for num, segment in algorithm.stream_segments(points, cutoff=cutoff, check_speed=check_speed,
+                                                  timegap=timegap):
+        spans.append([num, len(rows), len(rows) + len(segment)])
+        rows.extend(segment)
+    return Spans(rows, spans)
 
 
+@instrumentation.stage(points_arg=1)
+def find_metro_transfers(stations, segments, buffer_m):
+    '''Join consecutive segments where the first ends and the second starts near different
+       metro stations within a plausible underground travel time. As in `algorithm`, only
+       the first transfer of a run of consecutive transfers joins its segments.'''
+    points = segments.points
+    linked = []
+    last_transfer = False
+    for num, start, end in segments.spans:
+        transfer = False
+        if linked:
+            segment1_end, segment2_start = points[start - 1], points[start]
+            segment1_end_p = (segment1_end['easting'], segment1_end['northing'])
+            segment2_start_p = (segment2_start['easting'], segment2_start['northing'])
+            intersect1, station1 = algorithm.metro_buffer(stations, segment1_end_p, buffer_m)
+            intersect2, station2 = algorithm.metro_buffer(stations, segment2_start_p, buffer_m)
+            if intersect1 and intersect2 and station1 != station2:
+                interval = (segment2_start['timestamp'] - segment1_end['timestamp']).total_seconds()
+                distance = tools.pythagoras(segment1_end_p, segment2_start_p)
+                if interval < 4800 and distance / interval > 0.1:
+                    labels.metro({1: [segment1_end], 2: [segment2_start]}, (1, 2))
+                    transfer = True
+        if transfer and not last_transfer:
+            linked[-1][2] = end
+        else:
+            linked.append([len(linked) + 1, start, end])
+        last_transfer = transfer
+    return Spans(points, linked)
 
 
+@instrumentation.stage()
+def connect_by_velocity(linked_trips):
+    '''Join each trip onto the trip before it when the gap between them was covered faster
+       than walking; the joined trip keeps the number of the first'''
+    points = linked_trips.points
+    connected = []
+    for num, start, end in linked_trips.spans:
+        if connected:
+            prev_p, next_p = points[start - 1], points[start]
+            period = int((next_p['timestamp'] - prev_p['timestamp']).total_seconds())
+            if tools.velocity_check((prev_p['easting'], prev_p['northing']),
+                                    (next_p['easting'], next_p['northing']),
+                                    period) is True:
+                labels.velocity([prev_p], [next_p])
+                connected[-1][2] = end
+                continue
+        connected.append([num, start, end])
+    return Spans(points, connected)
 
+
+@instrumentation.stage()
+def filter_single_points(linked_trips):
+    '''Attaches single point trips to the nearer of the trips before and after them,
+       matching `algorithm.filter_single_points` including its renumbering'''
+    points = linked_trips.points
+    trips = [list(span) for span in linked_trips.spans]
+    trip_nums = set(num for num, _, _ in trips)
+    # a point moved in time is still measured by the timestamp it was recorded at
+    recorded_timestamps = {}
+    cleaned = []
+    offset = 0
+    for idx, (num, start, end) in enumerate(trips):
+        if (idx != 0) and (num + 1 in trip_nums) and (num - 1 in trip_nums) and (end - start == 1):
+            point = points[start]
+            point['note'] = 'single point'
+            point_loc = (point['easting'], point['northing'])
+
+            last_trip_end = points[start - 1]
+            last_trip_pt = (last_trip_end['easting'], last_trip_end['northing'])
+            last_trip_dist = tools.pythagoras(last_trip_pt, point_loc)
+
+            next_trip_start = points[start + 1]
+            next_trip_pt = (next_trip_start['easting'], next_trip_start['northing'])
+            next_trip_dist = tools.pythagoras(point_loc, next_trip_pt)
+
+            recorded_timestamps[start] = point['timestamp']
+            if last_trip_dist <= next_trip_dist:
+                point['timestamp'] = recorded_timestamps.get(start - 1, last_trip_end['timestamp'])
+                labels.single_point(point, [points[cleaned[-1][2] - 1]], 'append')
+                cleaned[-1][2] = end
+            else:
+                point['timestamp'] = next_trip_start['timestamp']
+                labels.single_point(point, [next_trip_start], 'insert')
+                trips[idx + 1][1] = start
+            offset += 1
+        else:
+            cleaned.append([num - offset, start, end])
+    return Spans(points, cleaned)
+
+
+def span_trips(trips):
+    '''Materialize trip spans as the dictionary of point lists used by the later stages'''
+    return {num: trips.points[start:end] for num, start, end in trips.spans}
+
+
+@instrumentation.stage(points_arg=2)
 def run(parameters, metro_stations, points):
-	points = tools.process_utm(points)
-	if not points:
-		return None, None
-
-    high_accuracy_points = filter_accuracy(points, cutoff=parameters['accuracy_cutoff_meters'])
-    segment_groups = break_by_timegap(high_accuracy_points, timegap=parameters['break_interval_seconds'])
-    stations = metro_stations_utm(metro_stations)
-    metro_linked_trips = find_metro_transfers(stations, segment_groups, buffer_m=parameters['subway_buffer_meters'])
+    stations, points = algorithm.project_survey(parameters, metro_stations, points)
+    if not points:
+        return None, None
+
+    if parameters.get('decimate'):
+        points = algorithm.decimate(points, **algorithm.decimation_settings(parameters))
+    segments = break_into_segments(points,
+                                   cutoff=parameters['accuracy_cutoff_meters'],
+                                   check_speed=60,
+                                   timegap=parameters['break_interval_seconds'])
+    metro_linked_trips = find_metro_transfers(stations, segments, buffer_m=parameters['subway_buffer_meters'])
     velocity_connected_trips = connect_by_velocity(metro_linked_trips)
-    cleaned_trips = filter_single_points(velocity_connected_trips)
-    missing_trips = infer_missing_trips(stations, cleaned_trips)
-    rows = merge_trips(cleaned_trips, missing_trips, stations)
-    trips, summaries = summarize(rows)
-    return trips, summaries	
\ No newline at end of file
+    cleaned_trips = span_trips(filter_single_points(velocity_connected_trips))
+    missing_trips = algorithm.infer_missing_trips(stations, cleaned_trips)
+    rows = algorithm.merge_trips(cleaned_trips, missing_trips, stations)
+    trips, summaries = algorithm.summarize(rows)
+    return trips, summaries
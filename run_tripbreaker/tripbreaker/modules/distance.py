@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+'''Distance backends measuring meters between WGS84 points: exact UTM, haversine on the
+   sphere and a fast local plane. Each backend measures a pair of lat/lon points or arrays
+   of them; the planar backends also project points for the tripbreaker to measure with
+   `tools.pythagoras`, which does not depend on which plane the points were projected to.'''
+import math
+
+import numpy as np
+
+from tripbreaker.modules import tools
+
+
+WGS84_A = 6378137.
+WGS84_E2 = 6.69437999014e-3
+# mean earth radius used by haversine distances
+EARTH_RADIUS = 6371008.8
+UTM_SCALE_FACTOR = 0.9996
+
+
+def haversine(point1, point2):
+    '''Calculate the great-circle distance in meters between two (latitude, longitude) points'''
+    lat1, lon1 = math.radians(point1[0]), math.radians(point1[1])
+    lat2, lon2 = math.radians(point2[0]), math.radians(point2[1])
+    a = (math.sin((lat2 - lat1) / 2.) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2.) ** 2)
+    return 2. * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def haversine_arrays(latitudes1, longitudes1, latitudes2, longitudes2):
+    '''Calculate the great-circle distances in meters between arrays of lat/lon points'''
+    lat1, lon1 = np.radians(latitudes1), np.radians(longitudes1)
+    lat2, lon2 = np.radians(latitudes2), np.radians(longitudes2)
+    a = (np.sin((lat2 - lat1) / 2.) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2)
+    return 2. * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+def utm_scale_error(latitudes, longitudes, zone):
+    '''The largest relative error of UTM distances against the ellipsoid among points
+       projected into a zone, from the scale factor at their distance from its meridian'''
+    central_meridian = math.radians((zone[0] - 1) * 6 - 180 + 3)
+    lat, lon = np.radians(latitudes), np.radians(longitudes)
+    offsets = np.cos(lat) * np.sin(lon - central_meridian)
+    scales = UTM_SCALE_FACTOR / np.sqrt(1. - offsets ** 2)
+    return float(np.max(np.abs(scales - 1.))) if len(scales) else 0.
+
+
+class UTMBackend(object):
+    '''Projects every point into one UTM zone, the survey's or one chosen from the points'''
+    name = 'utm'
+    planar = True
+
+    def __init__(self, zone=None):
+        self.zone = zone
+
+    def project(self, latitudes, longitudes):
+        eastings, northings, valid, zone = tools.project_utm(latitudes, longitudes, zone=self.zone)
+        if self.zone is None:
+            self.zone = zone
+        return eastings, northings, valid
+
+    def distances(self, latitudes1, longitudes1, latitudes2, longitudes2):
+        '''Distances in meters between arrays of lat/lon points, in the backend's zone'''
+        eastings1, northings1, _ = self.project(latitudes1, longitudes1)
+        eastings2, northings2, _ = self.project(latitudes2, longitudes2)
+        return tools.pythagoras_arrays(eastings1, northings1, eastings2, northings2)
+
+    def distance(self, point1, point2):
+        return float(self.distances([point1[0]], [point1[1]], [point2[0]], [point2[1]])[0])
+
+
+class HaversineBackend(object):
+    '''Great-circle distances on a sphere of the earth's mean radius, without projecting'''
+    name = 'haversine'
+    planar = False
+
+    def distances(self, latitudes1, longitudes1, latitudes2, longitudes2):
+        return haversine_arrays(np.asarray(latitudes1, dtype=np.float64),
+                                np.asarray(longitudes1, dtype=np.float64),
+                                np.asarray(latitudes2, dtype=np.float64),
+                                np.asarray(longitudes2, dtype=np.float64))
+
+    def distance(self, point1, point2):
+        return haversine(point1, point2)
+
+
+class LocalPlaneBackend(object):
+    '''Projects points onto an east/north plane tangent to the WGS84 ellipsoid at an anchor,
+       the median of the first points projected unless given, by scaling their latitude and
+       longitude offsets by the meridional and prime vertical radii at the anchor. This skips
+       UTM projection entirely at the cost of an error that grows with the distance from the
+       anchor: the relative error of a distance between points within `d` meters north or
+       south of the anchor at latitude `lat` is at most about tan(|lat|) * d / 6371000, plus
+       the scale error of UTM itself when compared to UTM (see `max_relative_error`). Over a
+       city 10 km across at 45 degrees this is about 0.1%, a few centimetres on the tens of
+       meters between a user's consecutive points, so it suits city-scale surveys only.'''
+    name = 'local'
+    planar = True
+
+    def __init__(self, anchor=None):
+        self.anchor = anchor
+
+    def radii(self):
+        sin_lat = math.sin(math.radians(self.anchor[0]))
+        w = 1. - WGS84_E2 * sin_lat ** 2
+        meridional = WGS84_A * (1. - WGS84_E2) / w ** 1.5
+        prime_vertical = WGS84_A / math.sqrt(w)
+        return meridional, prime_vertical
+
+    def project(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        valid = tools.utm_valid_mask(latitudes, longitudes)
+        if self.anchor is None and valid.any():
+            self.anchor = (float(np.median(latitudes[valid])), float(np.median(longitudes[valid])))
+
+        eastings = np.full(latitudes.shape, np.nan)
+        northings = np.full(latitudes.shape, np.nan)
+        if self.anchor is not None:
+            meridional, prime_vertical = self.radii()
+            east_scale = prime_vertical * math.cos(math.radians(self.anchor[0]))
+            eastings[valid] = np.radians(longitudes[valid] - self.anchor[1]) * east_scale
+            northings[valid] = np.radians(latitudes[valid] - self.anchor[0]) * meridional
+        return eastings, northings, valid
+
+    def distances(self, latitudes1, longitudes1, latitudes2, longitudes2):
+        eastings1, northings1, _ = self.project(latitudes1, longitudes1)
+        eastings2, northings2, _ = self.project(latitudes2, longitudes2)
+        return tools.pythagoras_arrays(eastings1, northings1, eastings2, northings2)
+
+    def distance(self, point1, point2):
+        return float(self.distances([point1[0]], [point1[1]], [point2[0]], [point2[1]])[0])
+
+    def max_relative_error(self, latitudes, longitudes, zone=None):
+        '''Bound the relative error of distances between the given points against the
+           ellipsoid, or against UTM distances in a zone when one is given'''
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if not len(latitudes):
+            return 0.
+        if self.anchor is None:
+            self.project(latitudes, longitudes)
+        # the east scale is exact at the anchor's latitude and off by the change in cos(lat)
+        # away from it, the north scale changes far more slowly and is covered by the margin
+        offsets = np.radians(np.abs(latitudes - self.anchor[0]))
+        steepest = np.tan(np.radians(np.minimum(np.abs(latitudes) + np.degrees(offsets), 89.)))
+        error = float(np.max(steepest * offsets)) * 1.01
+        if zone is not None:
+            error += utm_scale_error(latitudes, longitudes, zone)
+        return error
+
+
+BACKENDS = {
+    'utm': UTMBackend,
+    'haversine': HaversineBackend,
+    'local': LocalPlaneBackend
+}
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+'''Per-stage instrumentation of the tripbreaker pipeline. Stages are wrapped with the
+   `stage` decorator, which only calls through to the stage until a `Registry` is enabled;
+   once enabled, each call records its wall and CPU time along with its points in and
+   out and the number of segments or trips it returned.'''
+import functools
+import json
+import time
+import types
+
+
+_registry = None
+
+
+def enable(registry=None):
+    '''Start recording stage calls to a registry, returned for reading the results'''
+    global _registry
+    _registry = registry if registry is not None else Registry()
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def current():
+    return _registry
+
+
+def count_points(value):
+    '''Count the points held by a stage's input or output: lists of points, dictionaries
+       of segments or trips, or a (trips, summaries) tuple. Iterators are not consumed.'''
+    if isinstance(value, tuple):
+        value = value[0]
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return sum(len(group) if isinstance(group, (list, tuple)) else 1
+                   for group in value.values())
+    if hasattr(value, '__len__'):
+        return len(value)
+    return None
+
+
+def count_groups(value):
+    if hasattr(value, 'spans'):
+        return len(value.spans)
+    if isinstance(value, tuple):
+        value = value[0]
+    if isinstance(value, dict):
+        return len(value)
+    return None
+
+
+def stage(name=None, points_arg=0):
+    '''Decorate a pipeline stage for instrumentation, `points_arg` is the position of the
+       argument holding the stage's input points (None when it has none). Generators
+       returned by lazy stages are consumed while instrumented so each stage is charged
+       for its own work.'''
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def instrumented(*args, **kwargs):
+            registry = _registry
+            if registry is None:
+                return func(*args, **kwargs)
+            points_in = None
+            if points_arg is not None and len(args) > points_arg:
+                points_in = count_points(args[points_arg])
+            t0, c0 = time.perf_counter(), time.process_time()
+            registry.depth += 1
+            try:
+                result = func(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+            finally:
+                registry.depth -= 1
+            registry.record(stage_name,
+                            wall=time.perf_counter() - t0,
+                            cpu=time.process_time() - c0,
+                            points_in=points_in,
+                            points_out=count_points(result),
+                            groups_out=count_groups(result))
+            return result
+        return instrumented
+    return decorator
+
+
+class measure(object):
+    '''Context manager recording a block of work, such as a database write, as a stage'''
+    __slots__ = ('name', 'points', 't0', 'c0')
+
+    def __init__(self, name, points=None):
+        self.name = name
+        self.points = points
+
+    def __enter__(self):
+        if _registry is not None:
+            self.t0, self.c0 = time.perf_counter(), time.process_time()
+            _registry.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if _registry is None:
+            return False
+        _registry.depth -= 1
+        if exc_type is None:
+            _registry.record(self.name,
+                             wall=time.perf_counter() - self.t0,
+                             cpu=time.process_time() - self.c0,
+                             points_in=self.points,
+                             points_out=self.points)
+        return False
+
+
+class Registry(object):
+    '''Collects stage records, each labelled with the user being processed at the time
+       and the depth of stages it was nested within'''
+    def __init__(self):
+        self.records = []
+        self.uuid = None
+        self.depth = 0
+
+    def record(self, stage_name, wall, cpu, points_in=None, points_out=None, groups_out=None):
+        self.records.append({
+            'uuid': self.uuid,
+            'stage': stage_name,
+            'wall': wall,
+            'cpu': cpu,
+            'points_in': points_in,
+            'points_out': points_out,
+            'groups_out': groups_out,
+            'depth': self.depth
+        })
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def stages(self):
+        '''Aggregate the records by stage in the order stages were first seen'''
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {'calls': 0, 'wall': 0., 'cpu': 0.,
+                                               'points_in': 0, 'points_out': 0,
+                                               'groups_out': 0})
+            s['calls'] += 1
+            s['wall'] += r['wall']
+            s['cpu'] += r['cpu']
+            for key in ('points_in', 'points_out', 'groups_out'):
+                if r[key] is not None:
+                    s[key] += r[key]
+        for s in stages.values():
+            s['points_dropped'] = s['points_in'] - s['points_out']
+            s['points_per_second'] = s['points_in'] / s['wall'] if s['wall'] else None
+        return stages
+
+    def users(self):
+        '''Aggregate the records by user, totalling each user's outermost stages'''
+        users = {}
+        for r in self.records:
+            if r['uuid'] is None:
+                continue
+            u = users.setdefault(r['uuid'], {'wall': 0., 'cpu': 0., 'points': None,
+                                             'stages': {}})
+            u['stages'][r['stage']] = u['stages'].get(r['stage'], 0.) + r['wall']
+            if r['depth'] == 0:
+                u['wall'] += r['wall']
+                u['cpu'] += r['cpu']
+            if r['stage'] == 'run':
+                u['points'] = r['points_in']
+        return users
+
+    def slowest_users(self, n=10):
+        users = self.users()
+        slowest = sorted(users.items(), key=lambda u: u[1]['wall'], reverse=True)[:n]
+        return [dict(u, uuid=uuid) for uuid, u in slowest]
+
+    def summary(self, slowest=10):
+        stages = self.stages()
+        users = self.users()
+        outermost = [r for r in self.records if r['depth'] == 0]
+        return {
+            'users': len(users),
+            'wall': sum(r['wall'] for r in outermost),
+            'cpu': sum(r['cpu'] for r in outermost),
+            'stages': stages,
+            'slowest_users': self.slowest_users(slowest)
+        }
+
+    def dump(self, fp, slowest=10):
+        with open(fp, 'w') as json_f:
+            json.dump(self.summary(slowest=slowest), json_f, indent=2)
+
+    def report(self, slowest=10):
+        lines = ['{stage:<28}{calls:>8}{wall:>12}{cpu:>12}{points_in:>12}{points_out:>12}'.format(
+            stage='stage', calls='calls', wall='wall (s)', cpu='cpu (s)',
+            points_in='points in', points_out='points out')]
+        for stage_name, s in self.stages().items():
+            lines.append('{stage:<28}{calls:>8}{wall:>12.3f}{cpu:>12.3f}{points_in:>12}{points_out:>12}'.format(
+                stage=stage_name, **s))
+        lines.append('slowest users:')
+        for u in self.slowest_users(slowest):
+            lines.append('  {uuid}: {wall:.3f} sec, {points} points'.format(**u))
+        return '\n'.join(lines)
+
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+'''Douglas-Peucker simplification of lines in projected meters. Rather than simplifying
+   once per tolerance, every point is given the largest tolerance at which Douglas-Peucker
+   still keeps it: the point a range is split at does not depend on the tolerance, so a
+   point is kept while the tolerance is below its own split distance and those of every
+   split above it. Ranges are split a level of the recursion at a time, measuring the
+   points of every range at that level at once.'''
+import numpy as np
+
+
+def segment_distances(eastings, northings, points, starts, ends):
+    '''Distances in meters from points to the segments between their start and end points,
+       indexes into the coordinate arrays'''
+    x, y = eastings[points], northings[points]
+    x1, y1 = eastings[starts], northings[starts]
+    dx, dy = eastings[ends] - x1, northings[ends] - y1
+    lengths = dx ** 2 + dy ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(((x - x1) * dx + (y - y1) * dy) / lengths, 0., 1.)
+    t[lengths == 0] = 0.
+    return np.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def line_tolerances(eastings, northings, line_ends):
+    '''Find the largest tolerance at which each point of a set of lines is kept, for lines
+       given as concatenated coordinates and the index after each line's last point. The
+       ends of each line are always kept; a line simplified to a tolerance keeps the points
+       whose value is greater than it.'''
+    eastings = np.asarray(eastings, dtype=np.float64)
+    northings = np.asarray(northings, dtype=np.float64)
+    line_ends = np.asarray(line_ends, dtype=np.int64)
+    line_starts = np.concatenate(([0], line_ends[:-1])).astype(np.int64)
+
+    kept = np.zeros(len(eastings))
+    kept[line_starts] = np.inf
+    kept[line_ends - 1] = np.inf
+    starts, ends = line_starts, line_ends - 1
+    caps = np.full(len(starts), np.inf)
+    while True:
+        interior = ends - starts - 1
+        splitting = interior > 0
+        starts, ends, caps, interior = starts[splitting], ends[splitting], caps[splitting], interior[splitting]
+        if not len(starts):
+            break
+
+        # the interior points of every range, in order and range by range
+        owners = np.repeat(np.arange(len(starts)), interior)
+        offsets = np.concatenate(([0], np.cumsum(interior)[:-1]))
+        points = np.arange(len(owners)) - offsets[owners] + starts[owners] + 1
+        distances = segment_distances(eastings, northings, points, starts[owners], ends[owners])
+        distances[np.isnan(distances)] = 0.
+        largest = np.maximum.reduceat(distances, offsets)
+
+        # each range splits at its first point furthest from the segment
+        furthest = np.flatnonzero(distances == largest[owners])
+        first = furthest[np.concatenate(([True], owners[furthest][1:] != owners[furthest][:-1]))]
+        splits = points[first]
+        caps = np.minimum(largest, caps)
+        kept[splits] = caps
+        starts, ends = np.concatenate((starts, splits)), np.concatenate((splits, ends))
+        caps = np.concatenate((caps, caps))
+    return kept
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+'''Grid hash over UTM metro station coordinates for radius and nearest-station queries,
+   which can be compiled with its stations to a binary file and memory-mapped'''
+import csv
+import json
+import math
+import os
+import struct
+
+import numpy as np
+
+from tripbreaker.modules import tools
+
+
+# a compiled index file starts with this magic and the length of its JSON header, followed
+# by the header and the arrays it lists, each aligned to 8 bytes from the start of the file
+INDEX_MAGIC = b'TBSTNIDX'
+INDEX_PREFIX = struct.Struct('<8sQ')
+# station metadata columns read from a stations .csv by their lowercase header names
+CSV_COLUMNS = {
+    'latitude': ('latitude', 'y'),
+    'longitude': ('longitude', 'x'),
+    'name': ('station name', 'station', 'name'),
+    'osm_id': ('osm id', 'osm_id'),
+    'line': ('line', 'ligne')
+}
+_loaded_indexes = {}
+
+
+def read_stations_csv(csv_fp):
+    '''Read metro stations from a .csv with latitude/longitude or Y/X columns as dictionaries
+       of their coordinates and, where the .csv has them, station name, OSM id and line'''
+    metro_stations = []
+    with open(csv_fp, 'r', encoding='utf-8-sig') as stations_f:
+        for r in csv.DictReader(stations_f):
+            r = {key.strip().lower(): item for key, item in r.items() if key}
+            station = {}
+            for name, keys in CSV_COLUMNS.items():
+                key = next((k for k in keys if r.get(k) not in (None, '')), None)
+                if key is not None:
+                    station[name] = r[key]
+            station['latitude'] = float(station['latitude'])
+            station['longitude'] = float(station['longitude'])
+            metro_stations.append(station)
+    return metro_stations
+
+
+class StationIndex(object):
+    '''Buckets stations into square grid cells so that a lookup only tests the stations
+       in the cells overlapping its search radius. Lookups are memoized per index, so an
+       index built for a single run answers repeated trip endpoint queries from cache.
+       An index loaded from a compiled file also carries the UTM zone of its stations and
+       their input records, and is pickled as its file path.'''
+    def __init__(self, stations, cell_size=300., zone=None, cells=None, records=None,
+                 arrays=None, source=None):
+        self.stations = list(stations)
+        self.cell_size = float(cell_size)
+        self.zone = zone
+        self.records = records
+        self.arrays = arrays
+        self.source = source
+        if cells is None:
+            cells = {}
+            for idx, station in enumerate(self.stations):
+                cells.setdefault(self._cell(station), []).append(idx)
+        self.cells = cells
+        if self.cells:
+            columns = [c[0] for c in self.cells]
+            rows = [c[1] for c in self.cells]
+            self.bounds = (min(columns), min(rows), max(columns), max(rows))
+        self._buffer_cache = {}
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __reduce_ex__(self, protocol):
+        if self.source is not None:
+            return load_station_index, (self.source,)
+        return super(StationIndex, self).__reduce_ex__(protocol)
+
+    def view(self):
+        '''Return an index sharing this one's stations and grid with its own lookup cache,
+           so that an index kept for a whole survey does not cache every user's queries'''
+        view = StationIndex.__new__(StationIndex)
+        view.__dict__.update(self.__dict__)
+        view._buffer_cache = {}
+        return view
+
+    def _cell(self, point):
+        return (int(math.floor(point[0] / self.cell_size)),
+                int(math.floor(point[1] / self.cell_size)))
+
+    def _candidates(self, point, distance):
+        min_col, min_row = self._cell((point[0] - distance, point[1] - distance))
+        max_col, max_row = self._cell((point[0] + distance, point[1] + distance))
+        # large radii span more grid cells than there are occupied ones
+        if (max_col - min_col + 1) * (max_row - min_row + 1) > len(self.cells):
+            candidates = []
+            for (col, row), cell_stations in self.cells.items():
+                if min_col <= col <= max_col and min_row <= row <= max_row:
+                    candidates.extend(cell_stations)
+            return candidates
+
+        candidates = []
+        for col in range(min_col, max_col + 1):
+            for row in range(min_row, max_row + 1):
+                candidates.extend(self.cells.get((col, row), []))
+        return candidates
+
+    def within(self, point, distance):
+        '''Return all stations within `distance` meters of a point in their original order'''
+        matches = []
+        for idx in sorted(self._candidates(point, distance)):
+            if tools.pythagoras(self.stations[idx], point) <= distance:
+                matches.append(self.stations[idx])
+        return matches
+
+    def buffer(self, point, distance):
+        '''Return a boolean indicating whether a point is within a specified distance of any
+           station along with the first such station, matching `algorithm.metro_buffer`'''
+        key = (point, distance)
+        if key not in self._buffer_cache:
+            result = False, None
+            for idx in sorted(self._candidates(point, distance)):
+                if tools.pythagoras(self.stations[idx], point) <= distance:
+                    result = True, self.stations[idx]
+                    break
+            self._buffer_cache[key] = result
+        return self._buffer_cache[key]
+
+    def _ring(self, col, row, ring):
+        if ring == 0:
+            yield col, row
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield c, row - ring
+            yield c, row + ring
+        for r in range(row - ring + 1, row + ring):
+            yield col - ring, r
+            yield col + ring, r
+
+    def _ring_candidates(self, col, row, ring):
+        candidates = []
+        for cell in self._ring(col, row, ring):
+            candidates.extend(self.cells.get(cell, []))
+        return candidates
+
+    def nearest(self, point, max_distance=None):
+        '''Return the closest station to a point and its distance by searching outwards
+           ring by ring of grid cells, or (None, None) when nothing is within range'''
+        if not self.stations:
+            return None, None
+        col, row = self._cell(point)
+        min_col, min_row, max_col, max_row = self.bounds
+        max_ring = max(abs(col - min_col), abs(col - max_col),
+                       abs(row - min_row), abs(row - max_row))
+
+        best, best_distance = None, None
+        for ring in range(max_ring + 1):
+            # stations in this ring or beyond are at least (ring - 1) cells away
+            if best is not None and best_distance <= (ring - 1) * self.cell_size:
+                break
+            # walking many empty rings costs more than a plain scan of the stations
+            full_scan = (2 * ring + 1) ** 2 > 4 * len(self.cells)
+            if full_scan:
+                candidates = range(len(self.stations))
+            else:
+                candidates = self._ring_candidates(col, row, ring)
+            for idx in candidates:
+                distance = tools.pythagoras(self.stations[idx], point)
+                if best is None or distance < best_distance:
+                    best, best_distance = self.stations[idx], distance
+            if full_scan:
+                break
+
+        if best is None or (max_distance is not None and best_distance > max_distance):
+            return None, None
+        return best, best_distance
+
+
+def compile_station_index(metro_stations, index_fp, cell_size=300.):
+    '''Project metro stations into the UTM zone chosen for them and write them with their
+       input records and grid cells to a binary index file for `load_station_index`'''
+    latitudes = np.array([float(s['latitude']) for s in metro_stations], dtype=np.float64)
+    longitudes = np.array([float(s['longitude']) for s in metro_stations], dtype=np.float64)
+    zone = tools.select_utm_zone(latitudes, longitudes)
+    eastings, northings, valid, _ = tools.project_utm(latitudes, longitudes, zone=zone)
+    index = StationIndex(zip(eastings[valid].tolist(), northings[valid].tolist()),
+                         cell_size=cell_size)
+
+    # stations are numbered by line in order of first appearance, -1 without one
+    lines = list(dict.fromkeys(str(s['line']) for s in metro_stations if s.get('line') not in (None, '')))
+    line_codes = {line: code for code, line in enumerate(lines)}
+    cell_keys = sorted(index.cells)
+    arrays = [
+        ('latitude', latitudes),
+        ('longitude', longitudes),
+        ('easting', eastings),
+        ('northing', northings),
+        ('valid', valid),
+        ('line', np.array([line_codes.get(str(s.get('line')), -1) for s in metro_stations], dtype=np.int16)),
+        ('cell_column', np.array([c[0] for c in cell_keys], dtype=np.int64)),
+        ('cell_row', np.array([c[1] for c in cell_keys], dtype=np.int64)),
+        ('cell_start', np.cumsum([0] + [len(index.cells[c]) for c in cell_keys], dtype=np.int64)),
+        ('cell_stations', np.array([idx for c in cell_keys for idx in index.cells[c]], dtype=np.int32))
+    ]
+    header = {
+        'zone': list(zone) if zone else None,
+        'cell_size': float(cell_size),
+        'lines': lines,
+        'names': [s.get('name') for s in metro_stations],
+        'osm_ids': [s.get('osm_id') for s in metro_stations],
+        'arrays': {}
+    }
+
+    # lay the arrays out after the header, which has to be sized before their offsets are known
+    offset = 0
+    for name, values in arrays:
+        header['arrays'][name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+        offset += -(-values.nbytes // 8) * 8
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(INDEX_PREFIX.size + len(header_bytes)) % 8)
+    data_start = INDEX_PREFIX.size + len(header_bytes)
+    with open(index_fp, 'wb') as index_f:
+        index_f.write(INDEX_PREFIX.pack(INDEX_MAGIC, len(header_bytes)))
+        index_f.write(header_bytes)
+        for name, values in arrays:
+            index_f.seek(data_start + header['arrays'][name]['offset'])
+            index_f.write(np.ascontiguousarray(values).tobytes())
+        index_f.truncate(data_start + offset)
+    return index_fp
+
+
+def load_station_index(index_fp):
+    '''Memory-map a compiled station index file, read-only, and return it as a StationIndex
+       loaded once per process. The stations and grid are read from the mapping into the
+       index's own lists, so each worker that unpickles an index holds its own copy; what
+       it saves is projecting the stations and building the grid in every process.'''
+    index_fp = os.path.abspath(index_fp)
+    if index_fp in _loaded_indexes:
+        return _loaded_indexes[index_fp]
+
+    data = np.memmap(index_fp, dtype=np.uint8, mode='r')
+    magic, header_size = INDEX_PREFIX.unpack(data[:INDEX_PREFIX.size].tobytes())
+    if magic != INDEX_MAGIC:
+        raise ValueError('{fp} is not a compiled station index'.format(fp=index_fp))
+    header = json.loads(data[INDEX_PREFIX.size:INDEX_PREFIX.size + header_size].tobytes().decode('utf-8'))
+    data_start = INDEX_PREFIX.size + header_size
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(data, dtype=dtype, count=count,
+                                     offset=data_start + spec['offset']).reshape(spec['shape'])
+
+    valid = arrays['valid']
+    stations = zip(arrays['easting'][valid].tolist(), arrays['northing'][valid].tolist())
+    cell_start = arrays['cell_start'].tolist()
+    cell_stations = arrays['cell_stations'].tolist()
+    cells = {}
+    for i, cell in enumerate(zip(arrays['cell_column'].tolist(), arrays['cell_row'].tolist())):
+        cells[cell] = cell_stations[cell_start[i]:cell_start[i + 1]]
+
+    records = []
+    lines = header['lines']
+    for i, (lat, lon, line) in enumerate(zip(arrays['latitude'].tolist(), arrays['longitude'].tolist(),
+                                             arrays['line'].tolist())):
+        record = {'latitude': lat, 'longitude': lon}
+        for key, values in (('name', header['names']), ('osm_id', header['osm_ids'])):
+            if values[i] is not None:
+                record[key] = values[i]
+        if line >= 0:
+            record['line'] = lines[line]
+        records.append(record)
+
+    zone = (int(header['zone'][0]), bool(header['zone'][1])) if header['zone'] else None
+    index = StationIndex(stations, cell_size=header['cell_size'], zone=zone, cells=cells,
+                         records=records, arrays=arrays, source=index_fp)
+    _loaded_indexes[index_fp] = index
+    return index
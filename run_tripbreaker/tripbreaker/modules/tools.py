@@ -1,52 +1,77 @@
 #!/usr/bin/env python
 # Kyle Fitzsimmons, 2016
 import math
-import time
+import numpy as np
 import utm
 
-# python 2+3 cpickle import
-try:
-    import _pickle as cPickle
-except ImportError:
-    import cPickle
+from tripbreaker.modules import instrumentation
 
 
-def timeit(func):
-    def timed(*args, **kwargs):
-        t0 = time.time()
-        result = func(*args, **kwargs)
-        t1 = time.time()
+def utm_valid_mask(latitudes, longitudes):
+    '''Flag the lat/lon rows that fall within the bounds UTM is defined for'''
+    with np.errstate(invalid='ignore'):
+        return ((latitudes >= -80.) & (latitudes <= 84.) &
+                (longitudes >= -180.) & (longitudes <= 180.))
 
-        print('{func}(args, kwargs): {time} sec'.format(
-            func=func.__name__,
-            # args=args,
-            # kw=kwargs,
-            time=t1-t0))
-        return result
-    return timed
 
+def select_utm_zone(latitudes, longitudes):
+    '''Choose a single UTM zone for a set of WGS84 points from their median location,
+       returned as a (zone number, northern hemisphere) tuple or None if no point is valid'''
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    valid = utm_valid_mask(latitudes, longitudes)
+    if not valid.any():
+        return None
+    median_lat = float(np.median(latitudes[valid]))
+    median_lon = float(np.median(longitudes[valid]))
+    return utm.latlon_to_zone_number(median_lat, median_lon), median_lat >= 0
+
+
+def project_utm(latitudes, longitudes, zone=None):
+    '''Convert arrays of WGS84 lat/lons to UTM in one vectorized call with every point
+       forced into the same zone. Rows outside of the UTM bounds are flagged in the
+       returned mask (with NaN coordinates) instead of raising an error.'''
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    valid = utm_valid_mask(latitudes, longitudes)
+    if zone is None:
+        zone = select_utm_zone(latitudes[valid], longitudes[valid])
+
+    eastings = np.full(latitudes.shape, np.nan)
+    northings = np.full(latitudes.shape, np.nan)
+    if zone is not None and valid.any():
+        zone_number, northern = zone
+        eastings[valid], northings[valid], _, _ = utm.from_latlon(latitudes[valid],
+                                                                  longitudes[valid],
+                                                                  force_zone_number=zone_number,
+                                                                  force_northern=northern)
+    return eastings, northings, valid, zone
 
-# @timeit
-def process_utm(points):
-    '''Convert WGS84 lat/lon points to UTM for performing spatial queries'''
-    out_points = []
-    for p in points:
-        try:
-            p['latitude'], p['longitude'] = float(p['latitude']), float(p['longitude'])
-            p['easting'], p['northing'], _, _ = utm.from_latlon(p['latitude'], p['longitude'])
-            p['speed'] = float(p['speed'])
-            p['h_accuracy'] = float(p['h_accuracy'])
-            p['v_accuracy'] = float(p['v_accuracy'])
-            out_points.append(p)
-        except utm.error.OutOfRangeError:
-            pass
-    return out_points
 
+@instrumentation.stage()
+def process_utm(points, zone=None, projection=None):
+    '''Convert WGS84 lat/lon points to UTM for performing spatial queries, or to the plane
+       of a distance backend's `project` when one is given'''
+    points = list(points)
+    for p in points:
+        p['latitude'], p['longitude'] = float(p['latitude']), float(p['longitude'])
+    latitudes = np.fromiter((p['latitude'] for p in points), dtype=np.float64, count=len(points))
+    longitudes = np.fromiter((p['longitude'] for p in points), dtype=np.float64, count=len(points))
+    if projection is None:
+        eastings, northings, valid, _ = project_utm(latitudes, longitudes, zone=zone)
+    else:
+        eastings, northings, valid = projection(latitudes, longitudes)
 
-# hackish way to copy a dictionary faster than deepcopy
-# @timeit
-def quick_deepcopy(dictionary):
-    return cPickle.loads(cPickle.dumps(dictionary, -1))
+    out_points = []
+    for p, easting, northing, is_valid in zip(points, eastings.tolist(), northings.tolist(), valid.tolist()):
+        if not is_valid:
+            continue
+        p['easting'], p['northing'] = easting, northing
+        p['speed'] = float(p['speed'])
+        p['h_accuracy'] = float(p['h_accuracy'])
+        p['v_accuracy'] = float(p['v_accuracy'])
+        out_points.append(p)
+    return out_points
 
 
 def pythagoras(point1, point2):
@@ -57,6 +82,14 @@ def pythagoras(point1, point2):
     return d
 
 
+def pythagoras_arrays(eastings1, northings1, eastings2, northings2):
+    '''Calculate the distances in meters between arrays of UTM points, squaring with
+       `float_power` since it rounds the same as `pythagoras`'''
+    a = eastings2 - eastings1
+    b = northings2 - northings1
+    return np.sqrt(np.float_power(a, 2) + np.float_power(b, 2))
+
+
 def velocity_check(point1, point2, period):
     '''Check if a missing period is above a minimum velocity threshold to indicate that
        an unusually large time gap is a movement period and a continuation of a trip'''
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+'''Columnar (struct-of-arrays) storage for a user's GPS points. Rows are exposed to the
+   algorithm stages as lightweight `TrackPoint` views that read and write the arrays
+   in place, so no per-point dictionaries exist until results reach the writers.'''
+import calendar
+from datetime import datetime, timedelta
+import numpy as np
+
+from tripbreaker.modules import instrumentation, tools
+
+
+EPOCH = datetime(1970, 1, 1)
+
+# categorical vocabularies for the string-typed pipeline fields
+NOTES = [
+    '',
+    'trip with metro transfer',
+    'single point',
+    'complete trip',
+    'complete trip - metro',
+    'missing trip',
+    'missing trip - metro',
+    'missing trip - less than 250m',
+    'cold start'
+]
+MERGE_CODES = [
+    'metro',
+    'metro concordia',
+    'velocity',
+    'single point - before',
+    'single point - after',
+    'missing trip',
+    'missing trip - metro',
+    'missing trip - less than 250m',
+    'cold start'
+]
+
+# column name: (dtype, value stored for an unset row)
+COLUMNS = {
+    'id': (np.int64, 0),
+    'latitude': (np.float64, np.nan),
+    'longitude': (np.float64, np.nan),
+    'easting': (np.float64, np.nan),
+    'northing': (np.float64, np.nan),
+    'h_accuracy': (np.float64, np.nan),
+    'v_accuracy': (np.float64, np.nan),
+    'speed': (np.float64, np.nan),
+    'altitude': (np.float64, np.nan),
+    'timestamp': (np.int64, 0),
+    'segment_group': (np.int32, 0),
+    'break_period': (np.int64, 0),
+    'trip': (np.int32, 0),
+    'distance': (np.float64, np.nan),
+    'trip_distance': (np.float64, np.nan),
+    'avg_speed': (np.float64, np.nan),
+    'trip_code': (np.int16, 0),
+    'note': (np.int8, 0),
+    'merge_codes': (np.uint16, 0)
+}
+INPUT_COLUMNS = ('id', 'latitude', 'longitude', 'h_accuracy', 'v_accuracy',
+                 'speed', 'altitude', 'timestamp')
+
+
+def datetime_to_epoch(dt):
+    if dt.tzinfo is None:
+        return calendar.timegm(dt.timetuple())
+    return int(calendar.timegm(dt.utctimetuple()))
+
+
+class MergeCodes(object):
+    '''List-like view over a row's merge code bitmask'''
+    __slots__ = ('track', 'index')
+
+    def __init__(self, track, index):
+        self.track = track
+        self.index = index
+
+    def append(self, code):
+        self.track.add_merge_code(self.index, code)
+
+    def __iter__(self):
+        mask = int(self.track.merge_codes[self.index])
+        for bit, code in enumerate(self.track.merge_code_names):
+            if mask & (1 << bit):
+                yield code
+
+    def __len__(self):
+        return bin(int(self.track.merge_codes[self.index])).count('1')
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class TrackPoint(object):
+    '''Dictionary-like view over a single row of a PointTrack'''
+    __slots__ = ('track', 'index')
+
+    def __init__(self, track, index):
+        self.track = track
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.track.get_value(self.index, key)
+
+    def __setitem__(self, key, value):
+        self.track.set_value(self.index, key, value)
+
+    def __contains__(self, key):
+        return self.track.has_value(self.index, key)
+
+    def __eq__(self, other):
+        if isinstance(other, TrackPoint):
+            return self.track is other.track and self.index == other.index
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash((id(self.track), self.index))
+
+    def __reduce__(self):
+        return TrackPoint, (self.track, self.index)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return [key for key in self.track.keys() if key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def copy(self):
+        '''Materialize the row as a plain dictionary'''
+        row = dict(self.items())
+        if 'merge_codes' in row:
+            row['merge_codes'] = list(row['merge_codes'])
+        return row
+
+    def __repr__(self):
+        return 'TrackPoint({})'.format(self.copy())
+
+
+class PointTrack(object):
+    '''A user's points stored as one NumPy array per column: timestamps as int64 epoch
+       seconds, coordinates and accuracies as float64, notes as int8 codes into `NOTES`
+       and merge codes as a uint16 bitmask over `MERGE_CODES`. Timestamps are returned
+       as datetimes in the timezone of the track's first input point.'''
+    def __init__(self, columns, uuid=None, tzinfo=None, present=None, extras=None,
+                 note_names=None, merge_code_names=None):
+        self.uuid = uuid
+        self.tzinfo = tzinfo
+        self.columns = columns
+        # which rows have had each optional column set, mirroring missing dictionary keys
+        self.present = present if present is not None else {}
+        self.extras = extras if extras is not None else {}
+        self.note_names = list(note_names or NOTES)
+        self.merge_code_names = list(merge_code_names or MERGE_CODES)
+        self._note_codes = {n: i for i, n in enumerate(self.note_names)}
+        self._merge_bits = {c: i for i, c in enumerate(self.merge_code_names)}
+
+    @classmethod
+    def from_rows(cls, rows, uuid=None):
+        '''Build a track in a single pass over dictionaries with Python-typed input columns,
+           so a generator of database rows never has to be held in memory as a list'''
+        values = {name: [] for name in INPUT_COLUMNS}
+        tzinfo = None
+        for r in rows:
+            if uuid is None:
+                uuid = r.get('uuid')
+            for name in INPUT_COLUMNS:
+                values[name].append(r.get(name))
+            if tzinfo is None and r.get('timestamp') is not None:
+                tzinfo = r['timestamp'].tzinfo
+
+        size = len(values['timestamp'])
+        columns, present = {}, {}
+        for name, (dtype, fill) in COLUMNS.items():
+            column = values.pop(name, None)
+            if column is None:
+                columns[name] = np.full(size, fill, dtype=dtype)
+                # derived columns are absent until a stage sets them
+                present[name] = np.zeros(size, dtype=bool)
+                continue
+
+            mask = np.array([v is not None and v != '' for v in column], dtype=bool)
+            if name == 'timestamp':
+                column = [datetime_to_epoch(v) if v is not None else fill for v in column]
+            else:
+                column = [v if v is not None and v != '' else fill for v in column]
+            columns[name] = np.array(column, dtype=dtype)
+            if not mask.all():
+                present[name] = mask
+        return cls(columns, uuid=uuid, tzinfo=tzinfo, present=present)
+
+    @classmethod
+    def from_arrays(cls, arrays, uuid=None, tzinfo=None):
+        '''Build a track from typed input arrays, such as a user's slice of a Parquet file,
+           with timestamps as epoch seconds. Arrays already of their column's dtype are used
+           without copying and may be read-only; input columns not given are left unset.'''
+        size = len(arrays['timestamp'])
+        columns, present = {}, {}
+        for name, (dtype, fill) in COLUMNS.items():
+            column = arrays.get(name) if name in INPUT_COLUMNS else None
+            if column is None:
+                columns[name] = np.full(size, fill, dtype=dtype)
+                present[name] = np.zeros(size, dtype=bool)
+                continue
+            columns[name] = np.asarray(column, dtype=dtype)
+        return cls(columns, uuid=uuid, tzinfo=tzinfo, present=present)
+
+    def __len__(self):
+        return len(self.columns['timestamp'])
+
+    def __getitem__(self, index):
+        return TrackPoint(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TrackPoint(self, index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_note_codes'], state['_merge_bits']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._note_codes = {n: i for i, n in enumerate(self.note_names)}
+        self._merge_bits = {c: i for i, c in enumerate(self.merge_code_names)}
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns')
+        if columns is not None and name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def keys(self):
+        return ['uuid'] + list(COLUMNS.keys()) + sorted({k for e in self.extras.values() for k in e})
+
+    def points(self, indexes):
+        '''Yield row views for an array of row indexes'''
+        for index in indexes.tolist():
+            yield TrackPoint(self, index)
+
+    def take(self, indexes):
+        '''Return a new track holding only the selected rows (index array or boolean mask)'''
+        indexes = np.asarray(indexes)
+        if indexes.dtype == bool:
+            indexes = np.flatnonzero(indexes)
+        columns = {name: values[indexes] for name, values in self.columns.items()}
+        present = {name: mask[indexes] for name, mask in self.present.items()}
+        positions = {old: new for new, old in enumerate(indexes.tolist())}
+        extras = {positions[i]: dict(e) for i, e in self.extras.items() if i in positions}
+        return PointTrack(columns, uuid=self.uuid, tzinfo=self.tzinfo, present=present,
+                          extras=extras, note_names=self.note_names,
+                          merge_code_names=self.merge_code_names)
+
+    @instrumentation.stage('process_utm')
+    def project_utm(self, zone=None, projection=None):
+        '''Fill the easting/northing columns in place and return a track of only the rows
+           that could be projected, matching `tools.process_utm`'''
+        if projection is None:
+            eastings, northings, valid, _ = tools.project_utm(self.columns['latitude'],
+                                                              self.columns['longitude'],
+                                                              zone=zone)
+        else:
+            eastings, northings, valid = projection(self.columns['latitude'], self.columns['longitude'])
+        self.columns['easting'][:] = eastings
+        self.columns['northing'][:] = northings
+        for name in ('easting', 'northing'):
+            self.present[name] = valid.copy()
+        return self.take(valid)
+
+    def has_value(self, index, key):
+        if key in self.columns:
+            mask = self.present.get(key)
+            return mask is None or bool(mask[index])
+        return key == 'uuid' or key in self.extras.get(index, {})
+
+    def get_value(self, index, key):
+        values = self.columns.get(key)
+        if values is None:
+            if key == 'uuid':
+                return self.uuid
+            return self.extras[index][key]
+        mask = self.present.get(key)
+        if mask is not None and not mask[index]:
+            raise KeyError(key)
+        if key == 'timestamp':
+            seconds = int(values[index])
+            if self.tzinfo is None:
+                return EPOCH + timedelta(seconds=seconds)
+            return datetime.fromtimestamp(seconds, tz=self.tzinfo)
+        if key == 'note':
+            return self.note_names[values[index]]
+        if key == 'merge_codes':
+            return MergeCodes(self, index)
+        return values[index].item()
+
+    def set_value(self, index, key, value):
+        if key == 'uuid':
+            self.uuid = value
+            return
+        if key not in self.columns:
+            self.extras.setdefault(index, {})[key] = value
+            return
+        if key == 'timestamp':
+            value = datetime_to_epoch(value)
+        elif key == 'note':
+            value = self.note_code(value)
+        elif key == 'merge_codes':
+            mask = 0
+            for code in value:
+                mask |= 1 << self.merge_code_bit(code)
+            value = mask
+        self.columns[key][index] = value
+        mask = self.present.get(key)
+        if mask is not None:
+            mask[index] = True
+
+    def note_code(self, note):
+        if note not in self._note_codes:
+            self._note_codes[note] = len(self.note_names)
+            self.note_names.append(note)
+        return self._note_codes[note]
+
+    def merge_code_bit(self, code):
+        if code not in self._merge_bits:
+            if len(self.merge_code_names) >= 16:
+                raise ValueError('Too many distinct merge codes for bitmask: {}'.format(code))
+            self._merge_bits[code] = len(self.merge_code_names)
+            self.merge_code_names.append(code)
+        return self._merge_bits[code]
+
+    def add_merge_code(self, index, code):
+        self.columns['merge_codes'][index] |= 1 << self.merge_code_bit(code)
+        mask = self.present.get('merge_codes')
+        if mask is not None:
+            mask[index] = True
+
+    def to_rows(self):
+        '''Materialize every row as a dictionary for output'''
+        return [p.copy() for p in self]
+
+
+class RowColumns(object):
+    '''Column access to a list of rows mixing TrackPoint views and dictionaries, such as
+       the rows of `algorithm.merge_trips`. Views are read and written through their
+       track's arrays in one operation and only dictionary rows are visited one by one.'''
+    def __init__(self, rows, view_positions=None, view_indexes=None):
+        self.rows = rows
+        if view_positions is None:
+            is_view = np.array([t is TrackPoint for t in map(type, rows)], dtype=bool)
+            view_positions = np.flatnonzero(is_view)
+            view_indexes = np.array([rows[i].index for i in view_positions.tolist()], dtype=np.int64)
+        self.view_positions = view_positions
+        self.view_indexes = view_indexes
+        self.track = rows[int(view_positions[0])].track if len(view_positions) else None
+        if self.track is None:
+            self.dict_positions = list(range(len(rows)))
+        else:
+            is_dict = np.ones(len(rows), dtype=bool)
+            is_dict[view_positions] = False
+            self.dict_positions = np.flatnonzero(is_dict).tolist()
+
+    def select(self, start, end):
+        '''Column access to the rows between two positions'''
+        first, last = np.searchsorted(self.view_positions, [start, end])
+        return RowColumns(self.rows[start:end], self.view_positions[first:last] - start,
+                          self.view_indexes[first:last])
+
+    def dict_values(self, key):
+        if self.track is None:
+            return [row[key] for row in self.rows]
+        return [self.rows[i][key] for i in self.dict_positions]
+
+    def column(self, key, dtype=np.float64):
+        '''Read a numeric field of every row as an array'''
+        if self.track is None:
+            return np.array(self.dict_values(key), dtype=dtype)
+        values = np.empty(len(self.rows), dtype=dtype)
+        values[self.view_positions] = self.track.columns[key][self.view_indexes]
+        if self.dict_positions:
+            values[self.dict_positions] = self.dict_values(key)
+        return values
+
+    def notes(self):
+        '''Read every row's note as a list of strings'''
+        if self.track is None:
+            return self.dict_values('note')
+        notes = [None] * len(self.rows)
+        names = np.array(self.track.note_names, dtype=object)
+        codes = self.track.columns['note'][self.view_indexes]
+        for position, note in zip(self.view_positions.tolist(), names[codes].tolist()):
+            notes[position] = note
+        for position, note in zip(self.dict_positions, self.dict_values('note')):
+            notes[position] = note
+        return notes
+
+    def merge_codes(self):
+        '''Read every row's merge codes as a list of sequences, decoding only the views
+           that have any set'''
+        if self.track is None:
+            return self.dict_values('merge_codes')
+        merge_codes = [()] * len(self.rows)
+        masks = self.track.columns['merge_codes'][self.view_indexes]
+        for i in np.flatnonzero(masks).tolist():
+            merge_codes[int(self.view_positions[i])] = MergeCodes(self.track, int(self.view_indexes[i]))
+        for position, codes in zip(self.dict_positions, self.dict_values('merge_codes')):
+            merge_codes[position] = codes
+        return merge_codes
+
+    def assign(self, columns):
+        '''Write a list of values per field to every row in order, so a row listed twice
+           keeps its last values as it would from assigning row by row'''
+        if self.track is not None:
+            for key, values in columns.items():
+                self.track.columns[key][self.view_indexes] = np.asarray(values)[self.view_positions]
+                mask = self.track.present.get(key)
+                if mask is not None:
+                    mask[self.view_indexes] = True
+        if self.dict_positions:
+            if self.track is None:
+                dict_rows = self.rows
+            else:
+                dict_rows = [self.rows[i] for i in self.dict_positions]
+            for key, values in columns.items():
+                if dict_rows is not self.rows:
+                    values = [values[i] for i in self.dict_positions]
+                for row, value in zip(dict_rows, values):
+                    row[key] = value
+
+
+def materialize_trips(trips):
+    '''Convert the track views in a trips dictionary from `algorithm.run` into plain
+       dictionaries, for writers that need real rows (pickling, serializing)'''
+    materialized = {}
+    for trip_id, trip in trips.items():
+        rows = []
+        for p in trip:
+            row = p.copy()
+            row['merge_codes'] = list(row['merge_codes'])
+            rows.append(row)
+        materialized[trip_id] = rows
+    return materialized
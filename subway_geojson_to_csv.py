@@ -1,29 +1,63 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2017
+#
+# Convert the OSM subway stations .geojson to the stations .csv read by the
+# tripbreaker runners and compile the stations into a binary index file: their
+# UTM coordinates, lines, OSM ids and a prebuilt grid, memory-mapped by the
+# runners instead of projecting the stations for every user.
+import argparse
 import csv
 import json
+import os
+import sys
 
-SUBWAY_STATIONS_JSON = './data/subway_stations.geojson'
-SUBWAY_STATIONS_CSV = './data/subway_stations.csv'
-
-
-with open(SUBWAY_STATIONS_JSON, 'r') as geojson_f:
-    stations = json.loads(geojson_f.read())
-
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_tripbreaker'))
+from tripbreaker.modules.station_index import compile_station_index, load_station_index, read_stations_csv
 
-csv_rows = [
-    ['Station Name', 'Latitude', 'Longitude', 'OSM ID', 'Line']
-]
-for feature in stations['features']:
-    print(feature['properties'])
-    station_name = feature['properties'].get('name')
-    longitude, latitude = feature['geometry']['coordinates']
-    osm_id = feature['id']
-    line = feature.get('line')
-    csv_rows.append([station_name, latitude, longitude, osm_id, line])
-
-
-with open(SUBWAY_STATIONS_CSV, 'w') as csv_f:
-    writer = csv.writer(csv_f)
-    writer.writerows(csv_rows)
 
+SUBWAY_STATIONS_JSON = './data/subway_stations.geojson'
+SUBWAY_STATIONS_CSV = './data/subway_stations.csv'
+SUBWAY_STATIONS_INDEX = './data/subway_stations.idx'
+
+
+def convert_geojson(geojson_fp, csv_fp):
+    with open(geojson_fp, 'r') as geojson_f:
+        stations = json.loads(geojson_f.read())
+
+    csv_rows = [
+        ['Station Name', 'Latitude', 'Longitude', 'OSM ID', 'Line']
+    ]
+    for feature in stations['features']:
+        print(feature['properties'])
+        station_name = feature['properties'].get('name')
+        longitude, latitude = feature['geometry']['coordinates']
+        osm_id = feature['id']
+        line = feature.get('line')
+        csv_rows.append([station_name, latitude, longitude, osm_id, line])
+
+    with open(csv_fp, 'w') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerows(csv_rows)
+
+
+
+### main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert and compile the subway stations.')
+    parser.add_argument('--from-csv', metavar='CSV_FP',
+                        help='compile an existing stations .csv instead of converting the .geojson')
+    parser.add_argument('--index', metavar='INDEX_FP', default=SUBWAY_STATIONS_INDEX,
+                        help='compiled station index to write (default: {fp})'.format(
+                            fp=SUBWAY_STATIONS_INDEX))
+    parser.add_argument('--cell-size', type=float, default=300.,
+                        help='grid cell size of the index in meters (default: 300)')
+    args = parser.parse_args()
+
+    csv_fp = args.from_csv
+    if not csv_fp:
+        convert_geojson(SUBWAY_STATIONS_JSON, SUBWAY_STATIONS_CSV)
+        csv_fp = SUBWAY_STATIONS_CSV
+    compile_station_index(read_stations_csv(csv_fp), args.index, cell_size=args.cell_size)
+    index = load_station_index(args.index)
+    print('Compiled {n} stations in UTM zone {z} to {fp}'.format(n=len(index), z=index.zone,
+                                                                 fp=args.index))